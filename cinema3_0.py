@@ -1,31 +1,215 @@
 #!/usr/bin/env python3
+import time as timeModule
+startTime = timeModule.perf_counter() # before the other imports, for the cold-start report where 'processStart' cannot tell
+
 import logging
 import sqlite3
 from sqlite3 import Error
-from prettytable import PrettyTable
 import datetime
 import sys
+import json
+import threading
+import os
+import re
+import bisect
+import functools
  
+def PrettyTable(*args, **kwargs):
+    """
+    The function creates a prettytable.PrettyTable, importing prettytable on first use,
+    so batch and kiosk runs that never draw a table do not pay for the import.
+    """
+    from prettytable import PrettyTable as Table
+    return Table(*args, **kwargs)
+
+def availabilityExpression(alias, seatColumns):
+    """
+    The function builds the SQL expressions for the number of available seats of a row of the table 'seats'
+    and for the longest run of adjacent available seats in one seat row (e.g. A2 A3 A4).
+
+    Parameters:
+        alias (string): the name of the 'seats' row in the SQL, e.g. 'NEW' in a trigger
+        seatColumns (tuple): the seat columns, 'A1' ... 'E5'
+    Returns (free, adjacent)
+    """
+    free = ' + '.join('({}.{} = \'O\')'.format(alias, i) for i in seatColumns)
+    runs = []
+    for letter in sorted(set(i[0] for i in seatColumns)):
+        row = [i for i in seatColumns if i[0] == letter]
+        cases = []
+        for length in range(len(row), 0, -1):
+            windows = (' AND '.join('{}.{} = \'O\''.format(alias, i) for i in row[start:start + length]) for start in range(len(row) - length + 1))
+            cases.append('WHEN ({}) THEN {}'.format(') OR ('.join(windows), length))
+        runs.append('CASE ' + ' '.join(cases) + ' ELSE 0 END')
+    return free, 'max(' + ', '.join(runs) + ')'
+
 class Database:
     tableColumn = {'admin': ('username', 'password', 'firstname', 'lastname', 'email'),
                    'customers': ('username', 'password', 'firstname', 'lastname', 'email'),
-                   'booking': ('timeMark', 'username', 'filmID', 'date', 'time', 'seat'),
+                   'booking': ('timeMark', 'username', 'filmID', 'date', 'time', 'seat', 'auditorium'),
                    'film': ('filmID', 'film', 'description'),
-                   'filmTime': ('date', 'time', 'filmID'), 
-                   'seats': ('filmID', 'date', 'time', 'A1', 'A2', 'A3', 'A4', 'A5', 'B1', 'B2', 'B3', 'B4', 'B5', 'C1', 'C2', 'C3', 'C4', 'C5', 'D1', 'D2', 'D3', 'D4', 'D5', 'E1', 'E2', 'E3', 'E4', 'E5')}
-    def __init__(self, filename):
+                   'filmTime': ('date', 'time', 'filmID', 'auditorium', 'duration', 'finish'),
+                   'auditorium': ('auditoriumID', 'name'),
+                   'cancelled': ('date', 'time', 'filmID', 'timeMark', 'auditorium'),
+                   'price': ('date', 'time', 'auditorium', 'tier', 'front', 'middle', 'back'),
+                   'seats': ('filmID', 'date', 'time', 'auditorium', 'A1', 'A2', 'A3', 'A4', 'A5', 'B1', 'B2', 'B3', 'B4', 'B5', 'C1', 'C2', 'C3', 'C4', 'C5', 'D1', 'D2', 'D3', 'D4', 'D5', 'E1', 'E2', 'E3', 'E4', 'E5')}
+    seatColumn = tableColumn['seats'][4:] # 'A1' ... 'E5'
+    priceZone = (('front', 'AB', 8.0), ('middle', 'CD', 12.0), ('back', 'E', 10.0)) # (zone, seat rows, base price), as in tableColumn['price']
+    priceTier = ((0.0, 1.0), (0.5, 1.2), (0.8, 1.5)) # (occupancy from, price multiplier) of tier 0, 1, 2
+    seatZone = {letter: i for i, (zone, letters, base) in enumerate(priceZone) for letter in letters} # seat row -> index in priceZone
+    priceSelect = ', '.join('coalesce(price.{0}, {1}) AS {0}'.format(zone, base) for zone, letters, base in priceZone) # tier 0 until repriced
+    # (version, description, statements); applied in order by Cursor.migrate, recorded in PRAGMA user_version
+    migrations = ((1, 'base schema',
+                   ('CREATE TABLE IF NOT EXISTS customers (username text primary key, password text, firstname text, lastname text, email text);',
+                    'CREATE TABLE IF NOT EXISTS admin (username text primary key, password text, firstname text, lastname text, email text);',
+                    'CREATE TABLE IF NOT EXISTS booking (timeMark text, username text, filmID text, date text, time text, seat text, primary key(date, time, seat));',
+                    'CREATE TABLE IF NOT EXISTS filmTime (date text, time text, filmID text, PRIMARY KEY (date, time));',
+                    'CREATE TABLE IF NOT EXISTS seats (filmID text, date text, time text, ' + ', '.join('{} text DEFAULT O'.format(i) for i in seatColumn) + ', PRIMARY KEY (date, time));',
+                    'CREATE TABLE IF NOT EXISTS film (filmID text, film text, description text, primary key(film));')),
+                  (2, 'screening cancellation',
+                   ('CREATE TABLE IF NOT EXISTS cancelled (date text, time text, filmID text, timeMark text, PRIMARY KEY (date, time));',)),
+                  (3, 'waitlist',
+                   ('CREATE TABLE IF NOT EXISTS waitlist (waitID integer primary key autoincrement, timeMark text, username text, filmID text, date text, time text, seatNum integer, status text DEFAULT \'waiting\', seat text);',
+                    'CREATE INDEX IF NOT EXISTS waitlistQueue ON waitlist (date, time, status, waitID);')),
+                  (4, 'film search',
+                   ('CREATE VIRTUAL TABLE IF NOT EXISTS filmSearch USING fts5(filmID UNINDEXED, film, description, tokenize = \'unicode61 remove_diacritics 2\');',
+                    'INSERT INTO filmSearch (filmID, film, description) SELECT filmID, film, description FROM film WHERE NOT EXISTS (SELECT 1 FROM filmSearch);',
+                    'CREATE INDEX IF NOT EXISTS filmTimeFilm ON filmTime (filmID, date, time);')),
+                  (5, 'idempotency keys',
+                   ('CREATE TABLE IF NOT EXISTS request (requestKey text primary key, operation text, result text, expires text);',)),
+                  (6, 'admission queue',
+                   ('CREATE TABLE IF NOT EXISTS admission (ticket integer primary key autoincrement, username text, date text, time text, status text, seen real, admitted real, finished real);',
+                    'CREATE INDEX IF NOT EXISTS admissionQueue ON admission (date, time, status, ticket);')),
+                  (7, 'indexes for history, film joins and waitlist notices',
+                   ('CREATE INDEX IF NOT EXISTS bookingUser ON booking (username);',
+                    'CREATE INDEX IF NOT EXISTS filmFilmID ON film (filmID);',
+                    'CREATE INDEX IF NOT EXISTS waitlistUser ON waitlist (username, status);',
+                    'ANALYZE;')),
+                  (8, 'seat change log for delta exports',
+                   ('CREATE TABLE IF NOT EXISTS seatChange (seq integer primary key autoincrement, filmID text, date text, time text);',
+                    'CREATE TABLE IF NOT EXISTS exportMark (consumer text primary key, seq integer);',
+                    'CREATE TRIGGER IF NOT EXISTS seatsInserted AFTER INSERT ON seats BEGIN INSERT INTO seatChange (filmID, date, time) VALUES (NEW.filmID, NEW.date, NEW.time); END;',
+                    'CREATE TRIGGER IF NOT EXISTS seatsUpdated AFTER UPDATE ON seats BEGIN INSERT INTO seatChange (filmID, date, time) VALUES (NEW.filmID, NEW.date, NEW.time); END;',
+                    'CREATE TRIGGER IF NOT EXISTS seatsDeleted AFTER DELETE ON seats BEGIN INSERT INTO seatChange (filmID, date, time) VALUES (OLD.filmID, OLD.date, OLD.time); END;')),
+                  (9, 'seat availability for finding the next screenings',
+                   ('CREATE TABLE IF NOT EXISTS availability (date text, time text, filmID text, free integer, adjacent integer, PRIMARY KEY (date, time));',
+                    'CREATE INDEX IF NOT EXISTS availabilityFilm ON availability (filmID, date, time, free, adjacent);',
+                    'INSERT OR REPLACE INTO availability SELECT date, time, filmID, {}, {} FROM seats;'.format(*availabilityExpression('seats', seatColumn)),
+                    'CREATE TRIGGER IF NOT EXISTS availabilityInserted AFTER INSERT ON seats BEGIN INSERT OR REPLACE INTO availability VALUES (NEW.date, NEW.time, NEW.filmID, {}, {}); END;'.format(*availabilityExpression('NEW', seatColumn)),
+                    'CREATE TRIGGER IF NOT EXISTS availabilityUpdated AFTER UPDATE ON seats BEGIN INSERT OR REPLACE INTO availability VALUES (NEW.date, NEW.time, NEW.filmID, {}, {}); END;'.format(*availabilityExpression('NEW', seatColumn)),
+                    'CREATE TRIGGER IF NOT EXISTS availabilityDeleted AFTER DELETE ON seats BEGIN DELETE FROM availability WHERE date = OLD.date AND time = OLD.time; END;')),
+                  (10, 'occupancy-based price tables',
+                   ('CREATE TABLE IF NOT EXISTS price (date text, time text, tier integer, ' + ', '.join('{} real'.format(zone) for zone, letters, base in priceZone) + ', PRIMARY KEY (date, time));',)),
+                  (11, 'auditoriums and screening durations; screenings keyed by (auditorium, date, time)',
+                   ('CREATE TABLE IF NOT EXISTS auditorium (auditoriumID text primary key, name text);',
+                    'INSERT OR IGNORE INTO auditorium (auditoriumID, name) VALUES (\'1\', \'Screen 1\');',
+                    # the existing screenings run hourly in one auditorium
+                    'CREATE TABLE filmTimeByAuditorium (date text, time text, filmID text, auditorium text DEFAULT \'1\', duration integer CHECK (duration > 0), finish text, PRIMARY KEY (auditorium, date, time));',
+                    'INSERT INTO filmTimeByAuditorium SELECT date, time, filmID, \'1\', 60, strftime(\'%Y/%m/%d %H:%M\', replace(date, \'/\', \'-\') || \' \' || time, \'+60 minutes\') FROM filmTime;',
+                    'DROP TABLE filmTime;',
+                    'ALTER TABLE filmTimeByAuditorium RENAME TO filmTime;',
+                    'CREATE INDEX IF NOT EXISTS filmTimeFilm ON filmTime (filmID, date, time);',
+                    'CREATE INDEX IF NOT EXISTS filmTimeDate ON filmTime (date, time);',
+                    'CREATE TABLE seatsByAuditorium (filmID text, date text, time text, auditorium text DEFAULT \'1\', ' + ', '.join('{} text DEFAULT O'.format(i) for i in seatColumn) + ', PRIMARY KEY (auditorium, date, time));',
+                    'INSERT INTO seatsByAuditorium SELECT filmID, date, time, \'1\', ' + ', '.join(seatColumn) + ' FROM seats;',
+                    'DROP TABLE seats;', # drops its triggers too
+                    'ALTER TABLE seatsByAuditorium RENAME TO seats;',
+                    'CREATE TABLE bookingByAuditorium (timeMark text, username text, filmID text, date text, time text, seat text, auditorium text DEFAULT \'1\', primary key(auditorium, date, time, seat));',
+                    'INSERT INTO bookingByAuditorium SELECT timeMark, username, filmID, date, time, seat, \'1\' FROM booking;',
+                    'DROP TABLE booking;',
+                    'ALTER TABLE bookingByAuditorium RENAME TO booking;',
+                    'CREATE INDEX IF NOT EXISTS bookingUser ON booking (username);',
+                    'CREATE TABLE cancelledByAuditorium (date text, time text, filmID text, timeMark text, auditorium text DEFAULT \'1\', PRIMARY KEY (auditorium, date, time));',
+                    'INSERT INTO cancelledByAuditorium SELECT date, time, filmID, timeMark, \'1\' FROM cancelled;',
+                    'DROP TABLE cancelled;',
+                    'ALTER TABLE cancelledByAuditorium RENAME TO cancelled;',
+                    'ALTER TABLE waitlist ADD COLUMN auditorium text DEFAULT \'1\';',
+                    'DROP INDEX IF EXISTS waitlistQueue;',
+                    'CREATE INDEX IF NOT EXISTS waitlistQueue ON waitlist (auditorium, date, time, status, waitID);',
+                    'ALTER TABLE admission ADD COLUMN auditorium text DEFAULT \'1\';',
+                    'DROP INDEX IF EXISTS admissionQueue;',
+                    'CREATE INDEX IF NOT EXISTS admissionQueue ON admission (auditorium, date, time, status, ticket);',
+                    'ALTER TABLE seatChange ADD COLUMN auditorium text DEFAULT \'1\';',
+                    'CREATE TRIGGER IF NOT EXISTS seatsInserted AFTER INSERT ON seats BEGIN INSERT INTO seatChange (filmID, date, time, auditorium) VALUES (NEW.filmID, NEW.date, NEW.time, NEW.auditorium); END;',
+                    'CREATE TRIGGER IF NOT EXISTS seatsUpdated AFTER UPDATE ON seats BEGIN INSERT INTO seatChange (filmID, date, time, auditorium) VALUES (NEW.filmID, NEW.date, NEW.time, NEW.auditorium); END;',
+                    'CREATE TRIGGER IF NOT EXISTS seatsDeleted AFTER DELETE ON seats BEGIN INSERT INTO seatChange (filmID, date, time, auditorium) VALUES (OLD.filmID, OLD.date, OLD.time, OLD.auditorium); END;',
+                    'DROP TABLE availability;',
+                    'CREATE TABLE availability (date text, time text, auditorium text, filmID text, free integer, adjacent integer, PRIMARY KEY (auditorium, date, time));',
+                    'CREATE INDEX IF NOT EXISTS availabilityFilm ON availability (filmID, date, time, free, adjacent);',
+                    'CREATE INDEX IF NOT EXISTS availabilityDate ON availability (date, time, free, adjacent);',
+                    'INSERT INTO availability SELECT date, time, auditorium, filmID, {}, {} FROM seats;'.format(*availabilityExpression('seats', seatColumn)),
+                    'CREATE TRIGGER IF NOT EXISTS availabilityInserted AFTER INSERT ON seats BEGIN INSERT OR REPLACE INTO availability VALUES (NEW.date, NEW.time, NEW.auditorium, NEW.filmID, {}, {}); END;'.format(*availabilityExpression('NEW', seatColumn)),
+                    'CREATE TRIGGER IF NOT EXISTS availabilityUpdated AFTER UPDATE ON seats BEGIN INSERT OR REPLACE INTO availability VALUES (NEW.date, NEW.time, NEW.auditorium, NEW.filmID, {}, {}); END;'.format(*availabilityExpression('NEW', seatColumn)),
+                    'CREATE TRIGGER IF NOT EXISTS availabilityDeleted AFTER DELETE ON seats BEGIN DELETE FROM availability WHERE auditorium = OLD.auditorium AND date = OLD.date AND time = OLD.time; END;',
+                    'DROP TABLE price;', # recomputed by the next repricing
+                    'CREATE TABLE price (date text, time text, auditorium text, tier integer, ' + ', '.join('{} real'.format(zone) for zone, letters, base in priceZone) + ', PRIMARY KEY (auditorium, date, time));',
+                    'ANALYZE;')),
+                  (12, 'idempotency keys bound to the parameters of their request',
+                   ('ALTER TABLE request ADD COLUMN fingerprint text;',
+                    'DELETE FROM request;')), # the stored keys have no fingerprint and expire within requestTTL anyway
+                  (13, 'admission queue moved to its own database file',
+                   ('DROP TABLE IF EXISTS admission;',)),
+                  (14, 'repricing logged to the seat change log',
+                   ('CREATE TRIGGER IF NOT EXISTS priceChanged AFTER INSERT ON price BEGIN INSERT INTO seatChange (filmID, date, time, auditorium) '
+                    'SELECT filmID, date, time, auditorium FROM filmTime WHERE auditorium = NEW.auditorium AND date = NEW.date AND time = NEW.time; END;',)),
+                  (15, 'seat changes logged only while a delta export consumer is registered',
+                   ('DROP TRIGGER IF EXISTS seatsInserted;',
+                    'DROP TRIGGER IF EXISTS seatsUpdated;',
+                    'DROP TRIGGER IF EXISTS seatsDeleted;',
+                    'DROP TRIGGER IF EXISTS priceChanged;',
+                    'CREATE TRIGGER seatsInserted AFTER INSERT ON seats WHEN EXISTS (SELECT 1 FROM exportMark) BEGIN INSERT INTO seatChange (filmID, date, time, auditorium) VALUES (NEW.filmID, NEW.date, NEW.time, NEW.auditorium); END;',
+                    'CREATE TRIGGER seatsUpdated AFTER UPDATE ON seats WHEN EXISTS (SELECT 1 FROM exportMark) BEGIN INSERT INTO seatChange (filmID, date, time, auditorium) VALUES (NEW.filmID, NEW.date, NEW.time, NEW.auditorium); END;',
+                    'CREATE TRIGGER seatsDeleted AFTER DELETE ON seats WHEN EXISTS (SELECT 1 FROM exportMark) BEGIN INSERT INTO seatChange (filmID, date, time, auditorium) VALUES (OLD.filmID, OLD.date, OLD.time, OLD.auditorium); END;',
+                    'CREATE TRIGGER priceChanged AFTER INSERT ON price WHEN EXISTS (SELECT 1 FROM exportMark) BEGIN INSERT INTO seatChange (filmID, date, time, auditorium) '
+                    'SELECT filmID, date, time, auditorium FROM filmTime WHERE auditorium = NEW.auditorium AND date = NEW.date AND time = NEW.time; END;',
+                    'DELETE FROM seatChange WHERE NOT EXISTS (SELECT 1 FROM exportMark);'))) # the first delta export of a consumer sends every screening
+    requestTTL = datetime.timedelta(hours = 24) # how long a client may retry with the same idempotency key
+    archiveTable = ('filmTime', 'seats', 'booking', 'cancelled')
+    notCancelled = 'NOT EXISTS (SELECT 1 FROM cancelled WHERE cancelled.auditorium = filmTime.auditorium AND cancelled.date = filmTime.date AND cancelled.time = filmTime.time)'
+    defaultAuditorium = '1' # for batch operations that do not name one
+    defaultDuration = 120 # minutes
+    def __init__(self, filename, archiveFilename = None, queueFilename = None):
         self._filename = filename
+        self._archiveFilename = archiveFilename or os.path.splitext(filename)[0] + 'Archive.db'
+        self._queueFilename = queueFilename or os.path.splitext(filename)[0] + 'Queue.db'
         
     def getFilename(self):
         return self._filename
+
+    def getArchiveFilename(self):
+        return self._archiveFilename
+
+    def getQueueFilename(self):
+        return self._queueFilename
         
 class Cursor:
     def __init__(self, Database):
+        self._database = Database
         self._connection = sqlite3.connect(Database.getFilename()) # the connection to a database file
         self._cursor = self._connection.cursor()
+        self._feed = SeatFeed() # seat changes, published after each commit
+        self._profiler = None
+        self._version = None
+        self._archiveAttached = False
      
     def getConnection(self):
         return self._connection
+
+    def getDatabase(self):
+        return self._database
+
+    def getProfiler(self):
+        return self._profiler
+
+    def setProfiler(self, profiler):
+        """
+        The function times every statement of this Cursor with a QueryProfiler, from now on.
+        """
+        self._profiler = profiler
+        self._cursor = self._connection.cursor(functools.partial(ProfiledCursor, profiler = profiler))
+
+    def getFeed(self):
+        return self._feed
     
     def getCursor(self):
         return self._cursor
@@ -144,12 +328,12 @@ class Cursor:
         The function inserts a new row to the table 'booking'.
         
         Parameters:
-            data(tuple or list): the time mark, username, filmID, screening date, screening time and booked seats
+            data(tuple or list): the time mark, username, filmID, screening date, screening time, booked seats and auditorium
         """
         try:
             c = self.getCursor()
             columns = ', '.join(str(c) for c in Database.tableColumn['booking'])
-            s = 'INSERT INTO booking (' + columns + ') VALUES (?, ?, ?, ?, ?, ?);'
+            s = 'INSERT INTO booking (' + columns + ') VALUES (' + ', '.join('?' * len(Database.tableColumn['booking'])) + ');'
             c.execute(s, data)
             logging.info(s)
             self.getConnection().commit()
@@ -170,24 +354,56 @@ class Cursor:
             s = 'INSERT INTO film (' + columns + ') VALUES (?, ?, ?);'
             c.execute(s, data)
             logging.info(s)
+            s = 'INSERT INTO filmSearch (' + columns + ') VALUES (?, ?, ?);'
+            c.execute(s, data)
+            logging.info(s)
             self.getConnection().commit()
             print('Film added!')
         except Error as e:
+            self.getConnection().rollback()
             logging.info(e)
             print('This film already exists!')
             return Error
+
+    def searchFilms(self, keywords, limit = 10):
+        """
+        The function searches film titles and descriptions in the full-text index 'filmSearch'.
+        Every keyword is matched as a prefix; matches in the title rank higher than in the description.
+
+        Parameters:
+            keywords (string): the words the user typed
+            limit (int): the maximum number of films returned
+        Returns a list of (filmID, film, next screening date, next screening time), best match first;
+        the date and time are None if the film has no upcoming screening.
+        """
+        terms = ['"' + t.replace('"', '""') + '"*' for t in keywords.split()]
+        if not terms:
+            return []
+        now = datetime.datetime.now().strftime('%Y/%m/%d %H:%M')
+        s = ('SELECT filmSearch.filmID, filmSearch.film, '
+             '(SELECT date || \' \' || time FROM filmTime WHERE filmTime.filmID = filmSearch.filmID AND date || \' \' || time >= ? AND ' + Database.notCancelled + ' ORDER BY date, time LIMIT 1) '
+             'FROM filmSearch WHERE filmSearch MATCH ? ORDER BY bm25(filmSearch, 0.0, 10.0, 1.0) LIMIT ?;')
+        try:
+            c = self.getCursor()
+            c.execute(s, (now, ' '.join(terms), limit))
+            logging.info(s)
+            result = c.fetchall()
+        except Error as e:
+            logging.info(e)
+            return []
+        return [(r[0], r[1]) + (tuple(r[2].split(' ')) if r[2] else (None, None)) for r in result]
         
     def insertScreenTime(self, data):
         """
         The function inserts a new row to the table ' filmTime'.
         
         Parameters:
-            data(tuple or list): the filmID, film, description
+            data(tuple or list): the date, time, filmID, auditorium, duration in minutes and finish ('%Y/%m/%d %H:%M')
         """
         try:
             c = self.getCursor()
             columns = ', '.join(str(c) for c in Database.tableColumn['filmTime'])
-            s = 'INSERT INTO filmTime (' + columns + ') VALUES (?, ?, ?);'
+            s = 'INSERT INTO filmTime (' + columns + ') VALUES (' + ', '.join('?' * len(Database.tableColumn['filmTime'])) + ');'
             c.execute(s, data)
             logging.info(s)
             self.getConnection().commit()
@@ -202,12 +418,12 @@ class Cursor:
         The function inserts a new row to the table ' seats'.
         
         Parameters:
-            data(tuple or list): the filmID, date, time (all seats all default to 'O')
+            data(tuple or list): the filmID, date, time, auditorium and the status of every seat
         """
         try:
             c = self.getCursor()
             columns = ', '.join(str(c) for c in Database.tableColumn['seats'])
-            s = 'INSERT INTO seats (' + columns + ') VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);'
+            s = 'INSERT INTO seats (' + columns + ') VALUES (' + ', '.join('?' * len(Database.tableColumn['seats'])) + ');'
             c.execute(s, data)
             logging.info(s)
             self.getConnection().commit()
@@ -238,19 +454,20 @@ class Cursor:
         when a customer cancels his or her booking.
         
         Parameters:
-            key (tuple): (date, time) of the booking
+            key (tuple): (date, time, auditorium) of the booking
             columnTable (list): the booked seats
         """
         date = key[0]
         time = key[1]
+        auditorium = key[2]
         p = []
         for i in columnTable:
             temp = '{} = \'O\''.format(i)
             p.append(temp)
         pair = ', '.join(str(i) for i in p)
         c = self.getCursor()
-        s = 'UPDATE seats SET {} WHERE date = \'{}\' AND time = \'{}\';'
-        c.execute(s.format(pair, date, time))
+        s = 'UPDATE seats SET {} WHERE auditorium = \'{}\' AND date = \'{}\' AND time = \'{}\';'
+        c.execute(s.format(pair, auditorium, date, time))
         logging.info(s)
         self.getConnection().commit()
         
@@ -283,235 +500,1092 @@ class Cursor:
             self.getConnection().commit()
         except Error as e:
             logging.info(e)
-    
-        
-class CommandLine:
-    def __init__(self, Cursor):
-        self._cursor = Cursor
-        
-    def getCursor(self):
-        return self._cursor 
-    
-    def start(self):
+
+    def migrate(self):
         """
-        The function starts the command-line program.
+        The function creates or upgrades the schema by applying the migrations in 'Database.migrations'
+        that are newer than the version stored in the database. Each migration runs in its own transaction,
+        and every statement is safe to run again on a database that was set up by hand.
+        When the schema is up to date this costs a single PRAGMA.
+
+        Returns the schema version
         """
-        while True:
-            identity = input('\'A\' if you are an admin; \'C\' if you are a customer; \'N\' to create a new account; \'E\' to exit: ')
-            if identity.upper() != 'A' and identity.upper() != 'C' and identity.upper() != 'N' and identity.upper() != 'E':
-                print('Invalid input!')
-            else:
-                break
-        if identity.upper() == 'E':
-            return True # exitStatue = True
-        elif identity.upper() == 'N':
-            self.createNewCustomer()
-        loginUser = self.login(identity.upper())
-        if isinstance(loginUser, Customer):
-            action = input('Enter \'B\' to book a seat; enter \'P\' to update your profile; enter \'M\' to maneage your booking; enter \'L\' to log out: ')
-            actionValid = action.upper() == 'B' or action.upper() == 'P' or action.upper() == 'M' or action.upper() == 'L'
-            while action.upper() != 'L':
-                while not actionValid:
-                    print('Invalid input! Please try again.')
-                    logging.info('Invalid input!')
-                    action = input('Enter \'B\' to book a seat; enter \'P\' to update your profile; enter \'M\' to maneage your booking; enter \'L\' to log out: ')
-                    actionValid = action.upper() == 'B' or action.upper() == 'P' or action.upper() == 'M' or action.upper() == 'L'
-                if action.upper() == 'B':
-                    logging.info('Book')
-                    while True:
-                        selectedDate = self.displayFilms()
-                        bookSuccess = loginUser.book(selectedDate, self)
-                        if bookSuccess:
-                            break
-                elif action.upper() == 'P':
-                    logging.info('Update profile')
-                    loginUser.updateProfile(self)
-                elif action.upper() == 'M':
-                    logging.info('Manage booking')
-                    loginUser.manageBooking(self)
-                action = input('\nEnter \'B\' to book a seat; enter \'P\' to update your profile; enter \'M\' to maneage your booking; enter \'L\' to log out: ')
-                actionValid = action.upper() == 'B' or action.upper() == 'P' or action.upper() == 'M' or action.upper() == 'L'
-            self.logout(loginUser)
-            return False
-        else: # Admin
-            print('\n------------------------------------------')
-            print('   Welcome to the management system. ;)')
-            print('------------------------------------------\n')
-            action = input('Enter \'A\' to add films; enter \'O\' to output information; enter \'C\' to check booking; enter \'L\' to log out: ')
-            actionValid = action.upper() == 'A' or action.upper() == 'O' or action.upper() == 'C' or action.upper() == 'L'
-            while action.upper() != 'L':
-                while not actionValid:
-                    print('Invalid input! Please try again.')
-                    logging.info('Invalid input!')
-                    action = input('Enter \'A\' to add films; enter \'O\' to output information; enter \'C\' to check booking; enter \'L\' to log out: ')
-                    actionValid = action.upper() == 'A' or action.upper() == 'O' or action.upper() == 'C' or action.upper() == 'L'
-                if action.upper() == 'A':
-                    logging.info('Add films')
-                    loginUser.addFilm(self)
-                elif action.upper() == 'O':
-                    logging.info('Output information')
-                    loginUser.output(self)
-                elif action.upper() == 'C':
-                    logging.info('Check booking')
-                    while True:
-                        checkSuccess = loginUser.checkBooking(self)
-                        if checkSuccess:
-                            break
-                else:
-                    break
-                action = input('\nEnter \'A\' to add films; enter \'O\' to output information; enter \'C\' to check booking; enter \'L\' to log out: ')
-                actionValid = action.upper() == 'A' or action.upper() == 'O' or action.upper() == 'C' or action.upper() == 'L'
-            self.logout(loginUser)
-            return False         
-                
-    def createNewCustomer(self):
+        connection = self.getConnection()
+        c = self.getCursor()
+        c.execute('PRAGMA user_version;')
+        version = c.fetchone()[0]
+        for number, description, statements in Database.migrations:
+            if number <= version:
+                continue
+            connection.commit()
+            try:
+                c.execute('BEGIN;')
+                for s in statements:
+                    c.execute(s)
+                    logging.info(s)
+                c.execute('PRAGMA user_version = {};'.format(number))
+                connection.commit()
+            except Error as e:
+                connection.rollback()
+                logging.info('Migration %d (%s) failed: %s', number, description, e)
+                raise
+            version = number
+            logging.info('Schema migrated to version %d: %s', number, description)
+        self._version = version
+        return version
+
+    def getVersion(self):
         """
-        The function creates a new customer account.
+        The function returns the schema version found or reached by the last 'migrate'.
         """
-        inputUsername = input('Username: ')
-        occupied = Customer.checkUsername(inputUsername, self.getCursor())
-        while occupied:
-            inputUsername = input('Oops! The username is not available. Please try another one: ')
-            occupied = Customer.checkUsername(inputUsername, self.getCursor())
-        inputPassword = input('Password: ')
-        passwordConfirm = input('Please confirm your password: ')
-        confirm = False
-        while not confirm:
-            if inputPassword != passwordConfirm:
-                print('Password does not match, please try again.')
-                inputPassword = input('Password: ')
-                passwordConfirm = input('Please confirm your password: ')
-            else:
-                break
-        inputFirstname = input('Your first name: ')
-        inputLastname = input('Your last name: ')
-        inputEmail = input('Your email: ')
-        data = (inputUsername, inputPassword, inputFirstname, inputLastname, inputEmail)
-        self.getCursor().insertCustomer(data)
-        print('Account created!')
-        print('Please log in...')
-        logging.info('New customer account %s is created.', inputUsername)
-        
-    def login(self, identity):
+        return self._version
+
+    def scheduleReport(self, since = None, until = None):
         """
-        The function is called when a user attempts to log in.
-        
+        The function counts the available and booked seats of every screening that is not cancelled, in one query.
+
         Parameters:
-            identity (string): The user input. A if the user wants to log in as an admin;
-                               C if the user wants to log in as a customer.
-        Returns the User as loginUser
-        """
-        inputUsername = input('Username: ')
-        inputPassword = input('Password: ')
-        if identity.upper() == 'A':
-            classID = Admin
-        else:
-            classID = Customer
-        validUsername = classID.checkUsername(inputUsername, self.getCursor())
-        while not validUsername:
-            print('The username doesn\'t exist! Please try again.')
-            logging.info('%s %s username does not exist.', classID.getTable(), inputUsername)
-            inputUsername = input('Username: ')
-            inputPassword = input('Password: ')
-            validUsername = classID.checkUsername(inputUsername, self.getCursor())
-        correctPassword = classID.checkPassword(inputUsername, inputPassword, self.getCursor())
-        while not correctPassword:
-            print('The password is not correct! Please try again.')
-            logging.info('%s %s: incorrect password!', classID.getTable(), inputUsername)
-            inputPassword = input('Password: ')
-            correctPassword = classID.checkPassword(inputUsername, inputPassword, self.getCursor())
-        loginUser = classID(inputUsername, inputPassword)
-        logging.info('%s %s logged in successfully!', classID.getTable(), loginUser.getUsername())
-        print('Logged in successfully!')
-        return loginUser
-    
-    def displayFilms(self):
-        """
-        The function prompts the customer to select a date,
-        and displays the film list of film title, screening time and description on a selected day.
-        
-        Returns the selected date as selectedDate
+            since (int): only the screenings with an entry in 'seatChange' after this seq, all screenings if None
+            until (int): the last seq considered with 'since'
+        Returns a list of (filmID, film, date, time, auditorium, available, booked, then the price of each zone in Database.priceZone)
+        """
+        seatColumns = Database.seatColumn
+        available = ' + '.join('({} = \'O\')'.format(i) for i in seatColumns)
+        s = ('SELECT film.filmID, film.film, filmTime.date, filmTime.time, filmTime.auditorium, ' + available + ' AS available, ' + str(len(seatColumns)) + ' - (' + available + '), ' + Database.priceSelect + ' '
+             'FROM filmTime JOIN film ON film.filmID = filmTime.filmID JOIN seats ON seats.auditorium = filmTime.auditorium AND seats.date = filmTime.date AND seats.time = filmTime.time '
+             'LEFT JOIN price ON price.auditorium = filmTime.auditorium AND price.date = filmTime.date AND price.time = filmTime.time '
+             'WHERE ' + Database.notCancelled)
+        parameters = ()
+        if since is not None:
+            s += ' AND (filmTime.auditorium, filmTime.date, filmTime.time) IN (SELECT auditorium, date, time FROM seatChange WHERE seq > ? AND seq <= ?)'
+            parameters = (since, until)
+        s += ' ORDER BY CAST(film.filmID AS integer), filmTime.date, filmTime.time, filmTime.auditorium;'
+        c = self.getCursor()
+        c.execute(s, parameters)
+        logging.info(s)
+        return c.fetchall()
+
+    def seatPrices(self, filmID, date, time, auditorium):
         """
-        selectedDate = self.selectDate()
-        condition = 'date = \'{}\''.format(selectedDate)
-        tables = ('film', 'filmTime')
-        columns = ('film.filmID', 'film', 'time', 'description')
-        groups = ('')
-        times = []
-        for i in range(1, self.filmNum() + 1):
-            conditionID = condition + ' AND filmID = {}'.format(i)
-            times.append(self.getCursor().selectCondition('filmTime', conditionID, 'time'))
-        formattedTimes = [] # each film in one [] in formattedTimes
-        for i in times:
-            temp = []
-            for j in i:
-                temp = temp + list(j)
-            formattedTimes.append(temp)
-        filmInfo = self.getCursor().selectAll('film')
-        displayTable = PrettyTable(['Film ID', 'Film', 'Time', 'Description'])
-        title = 'Films on {}'.format(selectedDate)
-        displayTable.title = title
-        for r1, r2 in zip(filmInfo, formattedTimes):
-            displayTable.add_row([r1[0], CommandLine.formatMultipleLines(r1[1], 18), '\n'.join(r2), CommandLine.formatMultipleLines(r1[2], 35)])
-        print(displayTable)
-        logging.info('display films on {}'.format(selectedDate))
-        logging.info('\n' + str(displayTable))
-        return(selectedDate)
-                     
-    def logout(self, user):
+        The function reads the seat status of a screening together with the price of each zone.
+
+        Parameters:
+            filmID (string)
+            date (string)
+            time (string)
+            auditorium (string)
+        Returns (seats, prices): the status of each seat in Database.seatColumn and the price of each zone
+        in Database.priceZone, or Error if there is no such screening.
+        """
+        seatColumns = Database.seatColumn
+        s = ('SELECT ' + ', '.join('seats.' + i for i in seatColumns) + ', ' + Database.priceSelect + ' FROM seats '
+             'LEFT JOIN price ON price.auditorium = seats.auditorium AND price.date = seats.date AND price.time = seats.time '
+             'WHERE seats.filmID = ? AND seats.date = ? AND seats.time = ? AND seats.auditorium = ?;')
+        c = self.getCursor()
+        c.execute(s, (str(filmID), date, time, auditorium))
+        logging.info(s)
+        row = c.fetchone()
+        if row is None:
+            return Error
+        return (row[:len(seatColumns)], row[len(seatColumns):])
+
+    def scheduleChanges(self, consumer):
         """
-        The function logs out the user.
+        The function finds the screenings whose seats changed since the last delta export of a consumer.
+        Seat inserts, updates and deletes are logged to 'seatChange' by triggers, so the cost is
+        proportional to the number of changes rather than to the size of the schedule.
+        The triggers log only while some consumer has a mark: the first export of a consumer sends every screening.
+
         Parameters:
-            user (User)
+            consumer (string): the name of the downstream reader, e.g. 'reporting'
+        Returns (seq, changed, removed): the high-water mark to pass to 'markExported' once the export is written,
+        the rows of 'scheduleReport' for the changed screenings (every screening on the first export),
+        and the (filmID, film, date, time, auditorium) of the changed screenings that were cancelled or archived since.
         """
-        print('{} logged out successfully!\n'.format(user.getUsername()))
-        logging.info('{} logged out.'.format(user.getUsername()))
-        self.getCursor().getConnection().commit()
-        
-    def countAvailable(self, filmID, date, time):
+        c = self.getCursor()
+        c.execute('SELECT seq FROM exportMark WHERE consumer = ?;', (consumer,))
+        mark = c.fetchone()
+        c.execute('SELECT coalesce(max(seq), 0) FROM seatChange;')
+        seq = c.fetchone()[0]
+        if mark is None:
+            return seq, self.scheduleReport(), []
+        changed = self.scheduleReport(mark[0], seq)
+        s = ('SELECT DISTINCT seatChange.filmID, film.film, seatChange.date, seatChange.time, seatChange.auditorium FROM seatChange '
+             'LEFT JOIN film ON film.filmID = seatChange.filmID WHERE seq > ? AND seq <= ? ORDER BY seatChange.date, seatChange.time, seatChange.auditorium;')
+        c.execute(s, (mark[0], seq))
+        logging.info(s)
+        current = set(row[2:5] for row in changed)
+        removed = [row for row in c.fetchall() if row[2:5] not in current]
+        return seq, changed, removed
+
+    def nextScreenings(self, seatNum, filmID = None, adjacent = False, start = None, end = None, limit = 5):
         """
-        The function counts the available seats of the 'filmID' at 'time' on 'date'.
-        
+        The function finds the earliest screenings with enough available seats, in one query on the table 'availability',
+        which triggers keep up to date with the table 'seats'.
+
         Parameters:
-            filmID (string)
-            date (string)
-            time (string)
+            seatNum (int): the number of seats needed
+            filmID (string): the film, or None for any film
+            adjacent (bool): whether the seats must be next to each other in one seat row
+            start (tuple): the earliest (date, time), e.g. ('2019/01/10', '11:00'), or None
+            end (tuple): the latest (date, time), or None
+            limit (int): the number of screenings returned
+        Returns a list of (filmID, film, date, time, auditorium, free, adjacent)
+        """
+        condition = ['availability.{} >= ?'.format('adjacent' if adjacent else 'free'), Database.notCancelled.replace('filmTime', 'availability')]
+        parameters = [seatNum]
+        if filmID is not None:
+            condition.append('availability.filmID = ?')
+            parameters.append(str(filmID))
+        if start is not None:
+            condition.append('(availability.date, availability.time) >= (?, ?)')
+            parameters.extend(start)
+        if end is not None:
+            condition.append('(availability.date, availability.time) <= (?, ?)')
+            parameters.extend(end)
+        s = ('SELECT availability.filmID, film.film, availability.date, availability.time, availability.auditorium, availability.free, availability.adjacent '
+             'FROM availability LEFT JOIN film ON film.filmID = availability.filmID WHERE ' + ' AND '.join(condition) +
+             ' ORDER BY availability.date, availability.time LIMIT ?;')
+        parameters.append(limit)
+        c = self.getCursor()
+        c.execute(s, parameters)
+        logging.info(s)
+        return c.fetchall()
+
+    def repriceScreenings(self):
         """
-        condition = 'date = \'{}\' AND time = \'{}\''.format(date, time)
-        film = self.getCursor().selectCondition('film', 'filmID = {}'.format(filmID), 'film')
-        bookStatue = self.getCursor().selectCondition('seats', condition, 'A1', 'A2', 'A3', 'A4', 'A5', 'B1', 'B2', 'B3', 'B4', 'B5', 'C1', 'C2', 'C3', 'C4', 'C5', 'D1', 'D2', 'D3', 'D4', 'D5', 'E1', 'E2', 'E3', 'E4', 'E5')
-        available = 0
-        for i in bookStatue[0]:
-            if i == 'O':
-                available += 1
-        booked = 25 - available
-        return (available, booked)
-    
-    def displayFilm(self):
+        The function recomputes the price table in bulk, without committing: each screening gets the tier
+        of its occupancy in Database.priceTier and the zone prices of that tier. Only the screenings
+        whose occupancy crossed a threshold since the last run are rewritten, in one statement,
+        and a trigger logs them to 'seatChange' so that the next delta export sends their new prices.
+
+        Returns the number of screenings repriced
+        """
+        total = len(Database.seatColumn)
+        occupancy = '(1.0 - availability.free * 1.0 / {})'.format(total)
+        tier = 'CASE ' + ' '.join('WHEN {} >= {} THEN {}'.format(occupancy, start, i) for i, (start, multiplier) in reversed(list(enumerate(Database.priceTier)))) + ' END'
+        multiplier = 'CASE current.tier ' + ' '.join('WHEN {} THEN {}'.format(i, multiplier) for i, (start, multiplier) in enumerate(Database.priceTier)) + ' END'
+        s = ('INSERT OR REPLACE INTO price (' + ', '.join(Database.tableColumn['price']) + ') '
+             'SELECT current.date, current.time, current.auditorium, current.tier, ' + ', '.join('round({} * {}, 2)'.format(base, multiplier) for zone, letters, base in Database.priceZone) + ' '
+             'FROM (SELECT availability.date, availability.time, availability.auditorium, ' + tier + ' AS tier FROM availability) AS current '
+             'WHERE NOT EXISTS (SELECT 1 FROM price WHERE price.auditorium = current.auditorium AND price.date = current.date AND price.time = current.time AND price.tier = current.tier);')
+        c = self.getCursor()
+        c.execute(s)
+        logging.info(s)
+        repriced = c.rowcount
+        s = 'DELETE FROM price WHERE NOT EXISTS (SELECT 1 FROM availability WHERE availability.auditorium = price.auditorium AND availability.date = price.date AND availability.time = price.time);'
+        c.execute(s)
+        logging.info(s)
+        logging.info('%d screening(s) repriced', repriced)
+        return repriced
+
+    def markExported(self, consumer, seq):
         """
-        The function displays the films and their description.
+        The function records the high-water mark of a consumer after its delta export has been written,
+        and drops the changes that every consumer has exported already. It does not commit.
+
+        Parameters:
+            consumer (string): the name of the downstream reader
+            seq (int): the mark returned by 'scheduleChanges'
         """
-        filmList = self.getCursor().selectAll('film')
-        filmTable = PrettyTable(['FilmID', 'Film', 'Description'])
-        for r in filmList:
-            filmTable.add_row([r[0], CommandLine.formatMultipleLines(r[1], 20), CommandLine.formatMultipleLines(r[2], 40)])
-        print(filmTable)
-        
-    def displaySeats(self, seat):
+        c = self.getCursor()
+        c.execute('INSERT OR REPLACE INTO exportMark (consumer, seq) VALUES (?, ?);', (consumer, seq))
+        c.execute('DELETE FROM seatChange WHERE seq <= (SELECT min(seq) FROM exportMark);')
+        logging.info('Export mark of %s set to %d', consumer, seq)
+
+    def attachArchive(self, filename):
         """
-        The function returns the seat layout and available seats.
-        
+        The function attaches the archive database file as 'archive' and creates its tables if they do not exist yet,
+        or adds the columns that the live tables gained since the archive was created.
+
         Parameters:
-            seat (list): the list returned from the database
-        Returns:
-            seatTable (PrettyTable): The seat layout
-            available (int): the number of the available seats
+            filename (string): the archive database file
         """
-        count = 1
-        available = 0
-        row = []
-        seatTable = PrettyTable([' ', '1', '2', '3', '4', '5'])
-        seatTable.title = 'Screen'
+        self._archiveAttached = True
+        c = self.getCursor()
+        self.getConnection().commit() # cannot attach inside a transaction
+        c.execute('ATTACH DATABASE ? AS archive;', (filename,))
+        logging.info('Attaches the archive %s.', filename)
+        c.execute('SELECT count(*) FROM archive.sqlite_master;')
+        if c.fetchone()[0]: # the archive tables exist already
+            for table in Database.archiveTable:
+                c.execute('PRAGMA archive.table_info({});'.format(table))
+                archived = set(row[1] for row in c.fetchall())
+                c.execute('PRAGMA main.table_info({});'.format(table))
+                for cid, name, columnType, notNull, default, pk in c.fetchall():
+                    if name not in archived:
+                        s = 'ALTER TABLE archive.{} ADD COLUMN {} {}'.format(table, name, columnType) + (' DEFAULT ' + default if default is not None else '') + ';'
+                        c.execute(s)
+                        logging.info(s)
+            self.getConnection().commit()
+            return
+        for table in Database.archiveTable:
+            s = 'CREATE TABLE IF NOT EXISTS archive.{0} AS SELECT * FROM main.{0} WHERE 0;'.format(table)
+            c.execute(s)
+            logging.info(s)
+        s = 'CREATE INDEX IF NOT EXISTS archive.archiveBookingUser ON booking (username);'
+        c.execute(s)
+        logging.info(s)
+        self.getConnection().commit()
+
+    def useArchive(self):
+        """
+        The function attaches the archive of the database the first time it is needed (see 'attachArchive'),
+        so that opening a site does not write to the archive.
+        """
+        if not self._archiveAttached:
+            self.attachArchive(self.getDatabase().getArchiveFilename())
+
+    def archiveScreenings(self, before, batchSize = 200):
+        """
+        The function moves the screenings before a date, with their seats and bookings, to the archive.
+        Every batch of screenings is moved in its own transaction, so the live tables stay
+        available while a large backlog is archived.
+
+        Parameters:
+            before (string): screenings on earlier dates are archived, e.g. '2019/01/10'
+            batchSize (int): the number of screenings moved per transaction
+        Returns the number of screenings archived, or Error if a batch is rolled back.
+        """
+        self.useArchive()
+        c = self.getCursor()
+        inKeys = '(auditorium, date, time) IN (SELECT auditorium, date, time FROM archiveKey)'
+        archived = 0
+        c.execute('CREATE TEMP TABLE IF NOT EXISTS archiveKey (auditorium text, date text, time text, PRIMARY KEY (auditorium, date, time));')
+        while True:
+            try:
+                with self.getConnection():
+                    c.execute('DELETE FROM archiveKey;')
+                    s = 'INSERT INTO archiveKey (auditorium, date, time) SELECT auditorium, date, time FROM main.filmTime WHERE date < ? ORDER BY date, time LIMIT ?;'
+                    c.execute(s, (before, batchSize))
+                    logging.info(s)
+                    count = c.rowcount
+                    if count == 0:
+                        break
+                    for table in Database.archiveTable:
+                        columns = ', '.join(Database.tableColumn[table])
+                        s = 'INSERT INTO archive.{0} ({2}) SELECT {2} FROM main.{0} WHERE {1};'.format(table, inKeys, columns)
+                        c.execute(s)
+                        logging.info(s)
+                        s = 'DELETE FROM main.{0} WHERE {1};'.format(table, inKeys)
+                        c.execute(s)
+                        logging.info(s)
+                    s = 'DELETE FROM main.waitlist WHERE status != \'booked\' AND ' + inKeys + ';' # booked rows wait for the customer's notice
+                    c.execute(s)
+                    logging.info(s)
+            except Error as e:
+                logging.info(e)
+                return Error
+            archived += count
+        logging.info('%d screening(s) archived', archived)
+        return archived
+
+    def cancelScreenings(self, keys):
+        """
+        The function cancels one or more screenings in a single transaction.
+        The screenings are marked in the table 'cancelled', all their seats are released,
+        their bookings are removed and their waitlist is closed.
+
+        Parameters:
+            keys (list): the (date, time, auditorium) of each screening to cancel
+        Returns the affected bookings as a list of
+        (username, firstname, lastname, email, film, date, time, auditorium, seat),
+        or Error if the transaction is rolled back.
+        """
+        c = self.getCursor()
+        seatColumns = Database.seatColumn
+        inKeys = '(auditorium, date, time) IN (SELECT auditorium, date, time FROM cancelKey)'
+        timeMark = datetime.datetime.now().strftime('%Y/%m/%d %H:%M')
+        try:
+            with self.getConnection(): # commits once, or rolls back everything
+                c.execute('CREATE TEMP TABLE IF NOT EXISTS cancelKey (date text, time text, auditorium text, PRIMARY KEY (auditorium, date, time));')
+                c.execute('DELETE FROM cancelKey;')
+                c.executemany('INSERT OR IGNORE INTO cancelKey (date, time, auditorium) VALUES (?, ?, ?);', keys)
+                s = 'INSERT OR IGNORE INTO cancelled (date, time, filmID, timeMark, auditorium) SELECT date, time, filmID, ?, auditorium FROM filmTime WHERE ' + inKeys + ';'
+                c.execute(s, (timeMark,))
+                logging.info(s)
+                s = ('SELECT booking.username, customers.firstname, customers.lastname, customers.email, film.film, booking.date, booking.time, booking.auditorium, booking.seat '
+                     'FROM booking LEFT JOIN customers ON customers.username = booking.username LEFT JOIN film ON film.filmID = booking.filmID '
+                     'WHERE (booking.auditorium, booking.date, booking.time) IN (SELECT auditorium, date, time FROM cancelKey) ORDER BY booking.username;')
+                c.execute(s)
+                logging.info(s)
+                affected = c.fetchall()
+                s = 'UPDATE seats SET ' + ', '.join('{} = \'O\''.format(i) for i in seatColumns) + ' WHERE ' + inKeys + ';'
+                c.execute(s)
+                logging.info(s)
+                if self.getFeed().hasSubscribers():
+                    c.execute('SELECT filmID, date, time, auditorium FROM seats WHERE ' + inKeys + ';')
+                    for filmID, date, time, auditorium in c.fetchall():
+                        self.getFeed().stage(filmID, date, time, auditorium, seatColumns, 'O')
+                s = 'DELETE FROM booking WHERE ' + inKeys + ';'
+                c.execute(s)
+                logging.info(s)
+                s = 'DELETE FROM waitlist WHERE status = \'waiting\' AND ' + inKeys + ';'
+                c.execute(s)
+                logging.info(s)
+                s = 'UPDATE waitlist SET status = \'cancelled\' WHERE status = \'booked\' AND ' + inKeys + ';' # no longer shown as booked from the waitlist
+                c.execute(s)
+                logging.info(s)
+        except Error as e:
+            logging.info(e)
+            self.getFeed().discard()
+            return Error
+        self.getFeed().flush()
+        logging.info('%d screening(s) cancelled, %d booking(s) refunded', len(keys), len(affected))
+        return affected
+
+    def insertWaitlist(self, data):
+        """
+        The function inserts a new row to the table 'waitlist'.
+
+        Parameters:
+            data(tuple or list): the time mark, username, filmID, screening date, screening time, auditorium and number of seats wanted
+        """
+        try:
+            c = self.getCursor()
+            s = 'INSERT INTO waitlist (timeMark, username, filmID, date, time, auditorium, seatNum) VALUES (?, ?, ?, ?, ?, ?, ?);'
+            c.execute(s, data)
+            logging.info(s)
+            self.getConnection().commit()
+        except Error as e:
+            logging.info(e)
+            return Error
+
+    def promoteWaitlist(self, date, time, auditorium, freedSeats):
+        """
+        The function hands the freed seats of a screening, together with the seats that are
+        still open, to the customers at the head of its waitlist and writes the seat status.
+        It does not commit, so it runs inside the transaction that freed the seats.
+        The queue is served strictly first in, first out, and at most one waiting row
+        is read per seat on offer, however long the waitlist is.
+
+        Parameters:
+            date (string)
+            time (string)
+            auditorium (string)
+            freedSeats (list): the seats that have just been released (still 'X' in the table 'seats')
+        Returns the list of promoted (username, filmID, seat)
+        """
+        c = self.getCursor()
+        seatColumns = Database.seatColumn
+        s = 'SELECT filmID, ' + ', '.join(seatColumns) + ' FROM seats WHERE auditorium = ? AND date = ? AND time = ?;'
+        c.execute(s, (auditorium, date, time))
+        logging.info(s)
+        row = c.fetchone() or (None,)
+        openSeats = [i for i, status in zip(seatColumns, row[1:]) if status == 'O' and i not in freedSeats]
+        offered = list(freedSeats) + openSeats
+        s = 'SELECT waitID, username, filmID, seatNum FROM waitlist WHERE auditorium = ? AND date = ? AND time = ? AND status = \'waiting\' ORDER BY waitID LIMIT ?;'
+        c.execute(s, (auditorium, date, time, len(offered)))
+        logging.info(s)
+        queue = c.fetchall()
+        promoted = []
+        timeMark = datetime.datetime.now().strftime('%Y/%m/%d %H:%M')
+        columns = ', '.join(str(i) for i in Database.tableColumn['booking'])
+        taken = 0
+        for waitID, username, filmID, seatNum in queue:
+            if seatNum > len(offered) - taken: # the head of the queue does not fit, keep the order
+                break
+            seat = ' '.join(offered[taken:taken + seatNum])
+            taken += seatNum
+            c.execute('INSERT INTO booking (' + columns + ') VALUES (?, ?, ?, ?, ?, ?, ?);', (timeMark, username, filmID, date, time, seat, auditorium))
+            c.execute('UPDATE waitlist SET status = \'booked\', seat = ? WHERE waitID = ?;', (seat, waitID))
+            promoted.append((username, filmID, seat))
+            logging.info('Waitlist %s promoted: %s on %s at %s in auditorium %s', username, seat, date, time, auditorium)
+        pair = ['{} = \'X\''.format(i) for i in offered[len(freedSeats):taken]] # open seats now taken
+        pair += ['{} = \'O\''.format(i) for i in offered[taken:len(freedSeats)]] # freed seats nobody took
+        if pair:
+            s = 'UPDATE seats SET ' + ', '.join(pair) + ' WHERE auditorium = ? AND date = ? AND time = ?;'
+            c.execute(s, (auditorium, date, time))
+            logging.info(s)
+            self.getFeed().stage(row[0], date, time, auditorium, offered[len(freedSeats):taken], 'X')
+            self.getFeed().stage(row[0], date, time, auditorium, offered[taken:len(freedSeats)], 'O')
+        return promoted
+
+    def markNotified(self, username):
+        """
+        The function marks the promoted waitlist rows of a customer as notified.
+
+        Parameters:
+            username (string)
+        """
+        c = self.getCursor()
+        s = 'UPDATE waitlist SET status = \'notified\' WHERE username = ? AND status = \'booked\';'
+        c.execute(s, (username,))
+        logging.info(s)
+        self.getConnection().commit()
+
+    def lookupRequest(self, requestKey, operation, parameters):
+        """
+        The function returns the stored result of an idempotency key that has not expired.
+        The keys are shared by the menus and the batch mode, so the operations are named
+        as in Batch: 'book', 'cancel' and 'checkout'.
+
+        Parameters:
+            requestKey (string): the key the client sent, or None
+            operation (string): the operation the key is used for
+            parameters (list): the parameters of the request, which a retry must repeat exactly
+        Returns None if the request is new, the stored result if it is a retry,
+        or Error if the key was used for another operation or with other parameters.
+        """
+        if requestKey is None:
+            return None
+        c = self.getCursor()
+        s = 'SELECT operation, fingerprint, result FROM request WHERE requestKey = ? AND expires > ?;'
+        c.execute(s, (requestKey, datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')))
+        logging.info(s)
+        row = c.fetchone()
+        if row is None:
+            return None
+        if row[0] != operation or row[1] != Cursor.fingerprint(parameters):
+            logging.info('Request %s reused for another request', requestKey)
+            return Error
+        logging.info('Request %s replayed', requestKey)
+        return json.loads(row[2])
+
+    def recordRequest(self, requestKey, operation, parameters, result):
+        """
+        The function stores the result of a request under its idempotency key, without committing,
+        so that it is saved in the same transaction as the writes it describes.
+
+        Parameters:
+            requestKey (string): the key the client sent, or None
+            operation (string)
+            parameters (list): the parameters of the request (see 'lookupRequest')
+            result: any value that can be written as JSON
+        """
+        if requestKey is None:
+            return
+        expires = (datetime.datetime.now() + Database.requestTTL).strftime('%Y/%m/%d %H:%M:%S')
+        s = 'INSERT OR REPLACE INTO request (requestKey, operation, fingerprint, result, expires) VALUES (?, ?, ?, ?, ?);'
+        self.getCursor().execute(s, (requestKey, operation, Cursor.fingerprint(parameters), json.dumps(result), expires))
+        logging.info(s)
+
+    @staticmethod
+    def fingerprint(parameters):
+        """
+        The function returns the SHA-256 of the parameters of a request written as JSON.
+        """
+        import hashlib
+        return hashlib.sha256(json.dumps(parameters).encode()).hexdigest()
+
+    def purgeRequests(self):
+        """
+        The function deletes the expired idempotency keys.
+        """
+        c = self.getCursor()
+        s = 'DELETE FROM request WHERE expires <= ?;'
+        c.execute(s, (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'),))
+        logging.info(s)
+        self.getConnection().commit()
+
+    def releaseBooking(self, username, date, time, auditorium, seat, requestKey = None):
+        """
+        The function cancels a booking and offers its seats to the waitlist in a single transaction.
+
+        Parameters:
+            username (string)
+            date (string)
+            time (string)
+            auditorium (string)
+            seat (string): the booked seats, e.g. 'B3 B4'
+            requestKey (string): an idempotency key; a retry with the same key returns the first result
+        Returns the list of promoted (username, filmID, seat), or Error if there is no such booking
+        or the transaction is rolled back.
+        """
+        try:
+            with self.getConnection():
+                parameters = [username, date, time, auditorium, seat]
+                promoted = self.lookupRequest(requestKey, 'cancel', parameters)
+                if promoted is None:
+                    promoted = self.deleteBooking(username, date, time, auditorium, seat)
+                    if promoted is not Error:
+                        self.recordRequest(requestKey, 'cancel', parameters, promoted)
+        except Error as e:
+            logging.info(e)
+            self.getFeed().discard()
+            return Error
+        self.getFeed().flush()
+        return promoted
+
+    def makeBooking(self, username, filmID, date, time, auditorium, seats, requestKey = None):
+        """
+        The function books seats of one screening in a single transaction.
+
+        Parameters:
+            username (string)
+            filmID (string)
+            date (string)
+            time (string)
+            auditorium (string)
+            seats (list): the seats wanted, e.g. ['B3', 'B4']
+            requestKey (string): an idempotency key; a retry with the same key returns the first result
+        Returns the list of the seats that are taken (empty when the booking is made),
+        or Error if the screening does not exist or the transaction is rolled back.
+        """
+        try:
+            with self.getConnection():
+                parameters = [username, str(filmID), date, time, auditorium, list(seats)]
+                occupied = self.lookupRequest(requestKey, 'book', parameters)
+                if occupied is None:
+                    occupied = self.bookSeats(username, filmID, date, time, auditorium, seats)
+                    if occupied == []:
+                        self.recordRequest(requestKey, 'book', parameters, occupied)
+        except Error as e:
+            logging.info(e)
+            self.getFeed().discard()
+            return Error
+        self.getFeed().flush()
+        return occupied
+
+    def checkoutCart(self, username, cart, requestKey = None):
+        """
+        The function books the seats of every screening in a cart, all or nothing, in a single write transaction.
+
+        Parameters:
+            username (string)
+            cart (list): the (filmID, date, time, auditorium, seats) of each screening, seats e.g. ['B3', 'B4']
+            requestKey (string): an idempotency key; a retry with the same key returns the first result
+        Returns the conflicts found (see 'bookCart'), empty when every booking is made,
+        or Error if the transaction is rolled back.
+        """
+        connection = self.getConnection()
+        c = self.getCursor()
+        try:
+            connection.commit()
+            c.execute('BEGIN IMMEDIATE;') # take the write lock before reading the seats
+            parameters = [username, [[str(filmID), date, time, auditorium, list(seats)] for filmID, date, time, auditorium, seats in cart]]
+            conflicts = self.lookupRequest(requestKey, 'checkout', parameters)
+            if conflicts is None:
+                conflicts = self.bookCart(username, cart)
+            if conflicts: # conflicts, or Error if the key was used for another operation
+                connection.rollback()
+                self.getFeed().discard()
+                logging.info('Checkout of %s rolled back: %s', username, conflicts)
+                return conflicts
+            self.recordRequest(requestKey, 'checkout', parameters, conflicts)
+            connection.commit()
+        except Error as e:
+            logging.info(e)
+            connection.rollback()
+            self.getFeed().discard()
+            return Error
+        self.getFeed().flush()
+        logging.info('Checkout of %s: %d screening(s) booked', username, len(cart))
+        return conflicts
+
+    def bookCart(self, username, cart):
+        """
+        The function books the seats of every screening in a cart, without committing.
+        Every screening is checked, so all the conflicts are reported at once;
+        the caller rolls back when there is any.
+
+        Parameters:
+            username (string)
+            cart (list): the (filmID, date, time, auditorium, seats) of each screening
+        Returns the list of conflicts as (filmID, date, time, auditorium, occupied), where occupied is the list
+        of the seats that are taken, or None if the screening does not exist or is cancelled.
+        """
+        conflicts = []
+        for filmID, date, time, auditorium, seats in cart:
+            occupied = self.bookSeats(username, filmID, date, time, auditorium, seats)
+            if occupied is Error:
+                conflicts.append((filmID, date, time, auditorium, None))
+            elif occupied:
+                conflicts.append((filmID, date, time, auditorium, occupied))
+        return conflicts
+
+    def deleteBooking(self, username, date, time, auditorium, seat):
+        """
+        The function deletes a booking and offers its seats to the waitlist, without committing.
+        As in Customer.manageBooking, only the bookings of screenings after today can be cancelled.
+
+        Parameters:
+            username (string)
+            date (string)
+            time (string)
+            auditorium (string)
+            seat (string): the booked seats, e.g. 'B3 B4'
+        Returns the list of promoted (username, filmID, seat), or Error if there is no such booking
+        or its screening is not in the future.
+        """
+        if date <= datetime.date.today().strftime('%Y/%m/%d'):
+            logging.info('Booking of %s on %s is not in the future', username, date)
+            return Error
+        c = self.getCursor()
+        s = 'DELETE FROM booking WHERE username = ? AND auditorium = ? AND date = ? AND time = ? AND seat = ?;'
+        c.execute(s, (username, auditorium, date, time, seat))
+        logging.info(s)
+        if c.rowcount == 0:
+            return Error
+        return self.promoteWaitlist(date, time, auditorium, seat.split(' '))
+
+    def bookSeats(self, username, filmID, date, time, auditorium, seats):
+        """
+        The function books seats of one screening, without committing.
+        Nothing is written if any of the seats is taken.
+
+        Parameters:
+            username (string)
+            filmID (string)
+            date (string)
+            time (string)
+            auditorium (string)
+            seats (list): the seats wanted, e.g. ['B3', 'B4']
+        Returns the list of the seats that are taken (empty when the booking is made),
+        or Error if the screening does not exist or is cancelled.
+        """
+        c = self.getCursor()
+        s = ('SELECT ' + ', '.join(seats) + ' FROM seats WHERE filmID = ? AND auditorium = ? AND date = ? AND time = ? AND '
+             'NOT EXISTS (SELECT 1 FROM cancelled WHERE cancelled.auditorium = seats.auditorium AND cancelled.date = seats.date AND cancelled.time = seats.time);')
+        c.execute(s, (str(filmID), auditorium, date, time))
+        logging.info(s)
+        row = c.fetchone()
+        if row is None:
+            return Error
+        occupied = [i for i, status in zip(seats, row) if status == 'X']
+        if occupied:
+            return occupied
+        s = 'UPDATE seats SET ' + ', '.join('{} = \'X\''.format(i) for i in seats) + ' WHERE auditorium = ? AND date = ? AND time = ?;'
+        c.execute(s, (auditorium, date, time))
+        logging.info(s)
+        self.getFeed().stage(filmID, date, time, auditorium, seats, 'X')
+        formattedCurrentTime = datetime.datetime.now().strftime('%Y/%m/%d %H:%M')
+        columns = ', '.join(str(i) for i in Database.tableColumn['booking'])
+        s = 'INSERT INTO booking (' + columns + ') VALUES (?, ?, ?, ?, ?, ?, ?);'
+        c.execute(s, (formattedCurrentTime, username, str(filmID), date, time, ' '.join(seats), auditorium))
+        logging.info(s)
+        return []
+
+    @staticmethod
+    def screeningKey(date, time):
+        """
+        The function writes a screening date and time zero-padded, e.g. ('2019/1/5', '9:00') -> ('2019/01/05', '09:00'),
+        so that the stored (date, time) strings sort like the times they stand for.
+
+        Raises ValueError if the date or time is malformed.
+        """
+        start = datetime.datetime.strptime(date + ' ' + time, '%Y/%m/%d %H:%M')
+        return (start.strftime('%Y/%m/%d'), start.strftime('%H:%M'))
+
+    def findOverlap(self, auditorium, date, time, duration):
+        """
+        The function finds the screening in an auditorium that overlaps a new one.
+        The screenings of an auditorium never overlap each other, so ordered by start they are also
+        ordered by finish, and only the last one starting before the new one finishes can overlap it:
+        a single backward seek on the primary key (auditorium, date, time), O(log n) whatever the schedule.
+        Cancelled screenings are skipped, so their slots can be scheduled again.
+
+        Parameters:
+            auditorium (string)
+            date (string): e.g. '2019/01/10'
+            time (string): e.g. '11:00'
+            duration (int): the length of the new screening in minutes
+        Returns the (filmID, date, time, finish) of the overlapping screening, or None if the slot is free.
+        Raises ValueError if the date or time is malformed or the duration is not positive.
+        """
+        if int(duration) <= 0:
+            raise ValueError('duration must be positive')
+        start = datetime.datetime.strptime(date + ' ' + time, '%Y/%m/%d %H:%M')
+        finish = start + datetime.timedelta(minutes = int(duration))
+        c = self.getCursor()
+        s = ('SELECT filmID, date, time, finish FROM filmTime WHERE auditorium = ? AND (date, time) < (?, ?) AND ' + Database.notCancelled + ' '
+             'ORDER BY date DESC, time DESC LIMIT 1;')
+        c.execute(s, (auditorium, finish.strftime('%Y/%m/%d'), finish.strftime('%H:%M')))
+        logging.info(s)
+        row = c.fetchone()
+        if row is None or row[3] <= start.strftime('%Y/%m/%d %H:%M'):
+            return None
+        return row
+
+    def addAuditorium(self, auditoriumID, name):
+        """
+        The function adds an auditorium, without committing. Every auditorium has the seat layout of the table 'seats'.
+
+        Parameters:
+            auditoriumID (string)
+            name (string): e.g. 'Screen 2'
+        Raises sqlite3.IntegrityError if the auditorium exists already.
+        """
+        c = self.getCursor()
+        s = 'INSERT INTO auditorium (auditoriumID, name) VALUES (?, ?);'
+        c.execute(s, (str(auditoriumID), name))
+        logging.info(s)
+
+    def scheduleScreening(self, filmID, date, time, auditorium, duration):
+        """
+        The function adds a screening time and its empty seats in a single transaction.
+
+        Parameters:
+            filmID (string)
+            date (string)
+            time (string)
+            auditorium (string)
+            duration (int): in minutes
+        Returns None, or the error message if the screening is not added.
+        """
+        try:
+            with self.getConnection():
+                self.addScreening(filmID, date, time, auditorium, duration)
+        except Error as e:
+            logging.info(e)
+            return str(e)
+        return None
+
+    def addScreening(self, filmID, date, time, auditorium, duration):
+        """
+        The function adds a screening time and its empty seats, without committing.
+        A cancelled screening at the same date, time and auditorium is replaced, with its record in 'cancelled'.
+
+        Parameters:
+            filmID (string)
+            date (string)
+            time (string)
+            auditorium (string)
+            duration (int): in minutes
+        Raises sqlite3.IntegrityError if the auditorium does not exist, the duration is not positive
+        or the time slot overlaps another screening in it, and ValueError if the date or time is malformed.
+        """
+        date, time = Cursor.screeningKey(date, time) # findOverlap seeks on the stored strings
+        c = self.getCursor()
+        c.execute('SELECT 1 FROM auditorium WHERE auditoriumID = ?;', (str(auditorium),))
+        if c.fetchone() is None:
+            raise sqlite3.IntegrityError('no such auditorium')
+        if int(duration) <= 0: # findOverlap relies on every screening finishing after it starts
+            raise sqlite3.IntegrityError('duration must be positive')
+        if self.findOverlap(str(auditorium), date, time, duration) is not None:
+            raise sqlite3.IntegrityError('time slot occupied')
+        c.execute('SELECT 1 FROM cancelled WHERE auditorium = ? AND date = ? AND time = ?;', (str(auditorium), date, time))
+        if c.fetchone() is not None: # its bookings were refunded when it was cancelled
+            for table in ('seats', 'filmTime', 'cancelled'):
+                s = 'DELETE FROM {} WHERE auditorium = ? AND date = ? AND time = ?;'.format(table)
+                c.execute(s, (str(auditorium), date, time))
+                logging.info(s)
+        finish = datetime.datetime.strptime(date + ' ' + time, '%Y/%m/%d %H:%M') + datetime.timedelta(minutes = int(duration))
+        s = 'INSERT INTO filmTime (' + ', '.join(Database.tableColumn['filmTime']) + ') VALUES (?, ?, ?, ?, ?, ?);'
+        c.execute(s, (date, time, str(filmID), str(auditorium), int(duration), finish.strftime('%Y/%m/%d %H:%M')))
+        logging.info(s)
+        s = 'INSERT INTO seats (filmID, date, time, auditorium) VALUES (?, ?, ?, ?);' # all seats default to 'O'
+        c.execute(s, (str(filmID), date, time, str(auditorium)))
+        logging.info(s)
+
+
+class CommandLine:
+    def __init__(self, Cursor, admission = None, metrics = None, router = None):
+        self._cursor = Cursor
+        self._admission = admission or AdmissionController(Cursor)
+        self._metrics = metrics
+        self._router = router
+        
+    def getCursor(self):
+        return self._cursor 
+
+    def getMetrics(self):
+        return self._metrics
+
+    def getRouter(self):
+        return self._router
+
+    def getAdmission(self):
+        return self._admission
+    
+    def start(self):
+        """
+        The function starts the command-line program.
+        """
+        while True:
+            identity = input('\'A\' if you are an admin; \'C\' if you are a customer; \'N\' to create a new account; \'E\' to exit: ')
+            if identity.upper() != 'A' and identity.upper() != 'C' and identity.upper() != 'N' and identity.upper() != 'E':
+                print('Invalid input!')
+            else:
+                break
+        if identity.upper() == 'E':
+            return True # exitStatue = True
+        elif identity.upper() == 'N':
+            self.createNewCustomer()
+        loginUser = self.login(identity.upper())
+        if isinstance(loginUser, Customer):
+            loginUser.checkWaitlist(self)
+            action = input('Enter \'B\' to book a seat; enter \'T\' to book several screenings with a cart; enter \'S\' to search films; enter \'P\' to update your profile; enter \'M\' to maneage your booking; enter \'H\' to view your full history; enter \'L\' to log out: ')
+            actionValid = action.upper() == 'B' or action.upper() == 'T' or action.upper() == 'S' or action.upper() == 'P' or action.upper() == 'M' or action.upper() == 'H' or action.upper() == 'L'
+            while action.upper() != 'L':
+                while not actionValid:
+                    print('Invalid input! Please try again.')
+                    logging.info('Invalid input!')
+                    action = input('Enter \'B\' to book a seat; enter \'T\' to book several screenings with a cart; enter \'S\' to search films; enter \'P\' to update your profile; enter \'M\' to maneage your booking; enter \'H\' to view your full history; enter \'L\' to log out: ')
+                    actionValid = action.upper() == 'B' or action.upper() == 'T' or action.upper() == 'S' or action.upper() == 'P' or action.upper() == 'M' or action.upper() == 'H' or action.upper() == 'L'
+                if action.upper() == 'B':
+                    logging.info('Book')
+                    while True:
+                        selectedDate = self.displayFilms()
+                        bookSuccess = loginUser.book(selectedDate, self)
+                        if bookSuccess:
+                            break
+                elif action.upper() == 'T':
+                    logging.info('Cart')
+                    loginUser.cart(self)
+                elif action.upper() == 'S':
+                    logging.info('Search films')
+                    self.searchFilms()
+                elif action.upper() == 'P':
+                    logging.info('Update profile')
+                    loginUser.updateProfile(self)
+                elif action.upper() == 'M':
+                    logging.info('Manage booking')
+                    loginUser.manageBooking(self)
+                elif action.upper() == 'H':
+                    logging.info('Full booking history')
+                    loginUser.bookingHistory(self, True)
+                action = input('\nEnter \'B\' to book a seat; enter \'T\' to book several screenings with a cart; enter \'S\' to search films; enter \'P\' to update your profile; enter \'M\' to maneage your booking; enter \'H\' to view your full history; enter \'L\' to log out: ')
+                actionValid = action.upper() == 'B' or action.upper() == 'T' or action.upper() == 'S' or action.upper() == 'P' or action.upper() == 'M' or action.upper() == 'H' or action.upper() == 'L'
+            self.logout(loginUser)
+            return False
+        else: # Admin
+            print('\n------------------------------------------')
+            print('   Welcome to the management system. ;)')
+            print('------------------------------------------\n')
+            action = input('Enter \'A\' to add films; enter \'O\' to output information; enter \'C\' to check booking; enter \'X\' to cancel screenings; enter \'M\' to view metrics; enter \'L\' to log out: ')
+            actionValid = action.upper() == 'A' or action.upper() == 'O' or action.upper() == 'C' or action.upper() == 'X' or action.upper() == 'M' or action.upper() == 'L'
+            while action.upper() != 'L':
+                while not actionValid:
+                    print('Invalid input! Please try again.')
+                    logging.info('Invalid input!')
+                    action = input('Enter \'A\' to add films; enter \'O\' to output information; enter \'C\' to check booking; enter \'X\' to cancel screenings; enter \'M\' to view metrics; enter \'L\' to log out: ')
+                    actionValid = action.upper() == 'A' or action.upper() == 'O' or action.upper() == 'C' or action.upper() == 'X' or action.upper() == 'M' or action.upper() == 'L'
+                if action.upper() == 'A':
+                    logging.info('Add films')
+                    loginUser.addFilm(self)
+                elif action.upper() == 'O':
+                    logging.info('Output information')
+                    loginUser.output(self)
+                elif action.upper() == 'C':
+                    logging.info('Check booking')
+                    while True:
+                        checkSuccess = loginUser.checkBooking(self)
+                        if checkSuccess:
+                            break
+                elif action.upper() == 'X':
+                    logging.info('Cancel screenings')
+                    loginUser.cancelScreenings(self)
+                elif action.upper() == 'M':
+                    logging.info('View metrics')
+                    loginUser.showMetrics(self)
+                else:
+                    break
+                action = input('\nEnter \'A\' to add films; enter \'O\' to output information; enter \'C\' to check booking; enter \'X\' to cancel screenings; enter \'M\' to view metrics; enter \'L\' to log out: ')
+                actionValid = action.upper() == 'A' or action.upper() == 'O' or action.upper() == 'C' or action.upper() == 'X' or action.upper() == 'M' or action.upper() == 'L'
+            self.logout(loginUser)
+            return False         
+                
+    def createNewCustomer(self):
+        """
+        The function creates a new customer account.
+        """
+        inputUsername = input('Username: ')
+        occupied = Customer.checkUsername(inputUsername, self.getCursor())
+        while occupied:
+            inputUsername = input('Oops! The username is not available. Please try another one: ')
+            occupied = Customer.checkUsername(inputUsername, self.getCursor())
+        inputPassword = input('Password: ')
+        passwordConfirm = input('Please confirm your password: ')
+        confirm = False
+        while not confirm:
+            if inputPassword != passwordConfirm:
+                print('Password does not match, please try again.')
+                inputPassword = input('Password: ')
+                passwordConfirm = input('Please confirm your password: ')
+            else:
+                break
+        inputFirstname = input('Your first name: ')
+        inputLastname = input('Your last name: ')
+        inputEmail = input('Your email: ')
+        data = (inputUsername, inputPassword, inputFirstname, inputLastname, inputEmail)
+        self.getCursor().insertCustomer(data)
+        print('Account created!')
+        print('Please log in...')
+        logging.info('New customer account %s is created.', inputUsername)
+        
+    def login(self, identity):
+        """
+        The function is called when a user attempts to log in.
+        
+        Parameters:
+            identity (string): The user input. A if the user wants to log in as an admin;
+                               C if the user wants to log in as a customer.
+        Returns the User as loginUser
+        """
+        inputUsername = input('Username: ')
+        inputPassword = input('Password: ')
+        if identity.upper() == 'A':
+            classID = Admin
+        else:
+            classID = Customer
+        validUsername = classID.checkUsername(inputUsername, self.getCursor())
+        while not validUsername:
+            print('The username doesn\'t exist! Please try again.')
+            logging.info('%s %s username does not exist.', classID.getTable(), inputUsername)
+            inputUsername = input('Username: ')
+            inputPassword = input('Password: ')
+            validUsername = classID.checkUsername(inputUsername, self.getCursor())
+        correctPassword = classID.checkPassword(inputUsername, inputPassword, self.getCursor())
+        while not correctPassword:
+            print('The password is not correct! Please try again.')
+            logging.info('%s %s: incorrect password!', classID.getTable(), inputUsername)
+            inputPassword = input('Password: ')
+            correctPassword = classID.checkPassword(inputUsername, inputPassword, self.getCursor())
+        loginUser = classID(inputUsername, inputPassword)
+        logging.info('%s %s logged in successfully!', classID.getTable(), loginUser.getUsername())
+        print('Logged in successfully!')
+        return loginUser
+    
+    def displayFilms(self):
+        """
+        The function prompts the customer to select a date,
+        and displays the film list of film title, screening time and description on a selected day.
+        
+        Returns the selected date as selectedDate
+        """
+        selectedDate = self.selectDate()
+        condition = 'date = \'{}\' AND '.format(selectedDate) + Database.notCancelled
+        tables = ('film', 'filmTime')
+        columns = ('film.filmID', 'film', 'time', 'description')
+        groups = ('')
+        times = []
+        for i in range(1, self.filmNum() + 1):
+            conditionID = condition + ' AND filmID = {} ORDER BY filmTime.time, filmTime.auditorium'.format(i)
+            times.append(self.getCursor().selectCondition('filmTime JOIN auditorium ON auditorium.auditoriumID = filmTime.auditorium', conditionID, 'filmTime.time', 'auditorium.name'))
+        formattedTimes = [] # each film in one [] in formattedTimes
+        for i in times:
+            temp = []
+            for j in i:
+                temp.append('{} ({})'.format(*j))
+            formattedTimes.append(temp)
+        filmInfo = self.getCursor().selectAll('film')
+        displayTable = PrettyTable(['Film ID', 'Film', 'Time', 'Description'])
+        title = 'Films on {}'.format(selectedDate)
+        displayTable.title = title
+        for r1, r2 in zip(filmInfo, formattedTimes):
+            displayTable.add_row([r1[0], CommandLine.formatMultipleLines(r1[1], 18), '\n'.join(r2), CommandLine.formatMultipleLines(r1[2], 35)])
+        print(displayTable)
+        logging.info('display films on {}'.format(selectedDate))
+        logging.info('\n' + str(displayTable))
+        return(selectedDate)
+                     
+    def logout(self, user):
+        """
+        The function logs out the user.
+        Parameters:
+            user (User)
+        """
+        print('{} logged out successfully!\n'.format(user.getUsername()))
+        logging.info('{} logged out.'.format(user.getUsername()))
+        self.getCursor().getConnection().commit()
+        
+    def countAvailable(self, filmID, date, time, auditorium):
+        """
+        The function counts the available seats of the 'filmID' at 'time' on 'date' in 'auditorium'.
+        
+        Parameters:
+            filmID (string)
+            date (string)
+            time (string)
+            auditorium (string)
+        """
+        condition = 'date = \'{}\' AND time = \'{}\' AND auditorium = \'{}\''.format(date, time, auditorium)
+        film = self.getCursor().selectCondition('film', 'filmID = {}'.format(filmID), 'film')
+        bookStatue = self.getCursor().selectCondition('seats', condition, 'A1', 'A2', 'A3', 'A4', 'A5', 'B1', 'B2', 'B3', 'B4', 'B5', 'C1', 'C2', 'C3', 'C4', 'C5', 'D1', 'D2', 'D3', 'D4', 'D5', 'E1', 'E2', 'E3', 'E4', 'E5')
+        available = 0
+        for i in bookStatue[0]:
+            if i == 'O':
+                available += 1
+        booked = 25 - available
+        return (available, booked)
+    
+    def searchFilms(self):
+        """
+        The function prompts the customer for keywords and displays the matching films
+        with their next screening.
+        """
+        keywords = input('Please enter the keywords to search for: ')
+        result = self.getCursor().searchFilms(keywords)
+        if not result:
+            print('No film matches \'{}\'.'.format(keywords))
+            return
+        searchTable = PrettyTable(['Film ID', 'Film', 'Next Screening Date', 'Next Screening Time'])
+        searchTable.title = 'Search results for \'{}\''.format(keywords)
+        for r in result:
+            searchTable.add_row([r[0], CommandLine.formatMultipleLines(r[1], 30), r[2] or '-', r[3] or '-'])
+        print(searchTable)
+        logging.info('\n' + str(searchTable))
+
+    def exportSchedule(self, filename = None, consumer = None, fileFormat = 'csv'):
+        """
+        The function writes the films, dates, times and number of available and booked seats to a CSV or JSON Lines file.
+        With a consumer, only the screenings changed since that consumer's last export are written,
+        each with a status 'changed' or 'removed' (cancelled or archived), and the consumer's mark is moved on.
+
+        Parameters:
+            filename (string): the file to write, 'YYYYMMDD_HHMM_filmsAndSeats.csv' (or '..._filmsAndSeatsDelta.jsonl', ...) if None
+            consumer (string): the downstream reader of a delta export, None for the full schedule
+            fileFormat (string): 'csv' or 'jsonl'
+        Returns the filename
+        """
+        cursor = self.getCursor()
+        if consumer is None:
+            rows = [row + ('changed',) for row in cursor.scheduleReport()]
+        else:
+            seq, changed, removed = cursor.scheduleChanges(consumer)
+            rows = [row + ('changed',) for row in changed] + [row + (None,) * (2 + len(Database.priceZone)) + ('removed',) for row in removed]
+        if filename is None:
+            outputTime = datetime.datetime.now().strftime('%Y%m%d_%H%M')
+            filename = '{}_filmsAndSeats{}.{}'.format(outputTime, '' if consumer is None else 'Delta', fileFormat)
+        file = open(filename, 'w+') # w+ will create a new file if it doesn't exist
+        columns = ('filmID', 'film', 'date', 'time', 'auditorium', 'available_seats', 'booked_seats') + tuple(zone + '_price' for zone, letters, base in Database.priceZone) + ('status',)
+        if fileFormat == 'jsonl':
+            for row in rows:
+                file.write(json.dumps(dict(zip(columns, row))) + '\n')
+        elif consumer is None:
+            file.write(', '.join(columns[:-1]) + '\n')
+            for row in rows:
+                file.write(', '.join(str(i) for i in row[:-1]) + '\n')
+        else:
+            file.write(', '.join(columns) + '\n')
+            for row in rows:
+                file.write(', '.join('' if i is None else str(i) for i in row) + '\n')
+        file.close()
+        if consumer is not None:
+            connection = cursor.getConnection()
+            if connection.in_transaction: # a batch commits the mark with its group
+                cursor.markExported(consumer, seq)
+            else:
+                with connection:
+                    cursor.markExported(consumer, seq)
+        return filename
+
+    def displayFilm(self):
+        """
+        The function displays the films and their description.
+        """
+        filmList = self.getCursor().selectAll('film')
+        filmTable = PrettyTable(['FilmID', 'Film', 'Description'])
+        for r in filmList:
+            filmTable.add_row([r[0], CommandLine.formatMultipleLines(r[1], 20), CommandLine.formatMultipleLines(r[2], 40)])
+        print(filmTable)
+        
+    def displaySeats(self, seat):
+        """
+        The function returns the seat layout and available seats.
+        
+        Parameters:
+            seat (list): the list returned from the database
+        Returns:
+            seatTable (PrettyTable): The seat layout
+            available (int): the number of the available seats
+        """
+        count = 1
+        available = 0
+        row = []
+        seatTable = PrettyTable([' ', '1', '2', '3', '4', '5'])
+        seatTable.title = 'Screen'
         for i in seat[0]:
             row.append(i)
             if i == 'O':
@@ -598,9 +1672,11 @@ class CommandLine:
         """
         The function prompts the user to select a time slot
         
-        Returns the time slot
+        Returns the time slot and its auditorium as (time, auditorium)
         """
-        timeSlots = self.getCursor().selectCondition('filmTime', 'date = \'{}\' AND filmID = {}'.format(date, filmID), 'time')
+        condition = 'date = \'{}\' AND filmID = {} AND '.format(date, filmID) + Database.notCancelled + ' ORDER BY filmTime.time, filmTime.auditorium'
+        timeSlots = self.getCursor().selectCondition('filmTime JOIN auditorium ON auditorium.auditoriumID = filmTime.auditorium', condition, 'filmTime.time', 'filmTime.auditorium', 'auditorium.name')
+        timeSlots = [('{} ({})'.format(time, name), time, auditorium) for time, auditorium, name in timeSlots]
         cnt = CommandLine.printDate(timeSlots)
         if not cnt: # no available time slot
             print('No available time slot on this day...\nPlease try again.')
@@ -622,8 +1698,38 @@ class CommandLine:
                 validTime = False
             else:
                 validTime = int(timeNumber) >= 1 and int(timeNumber) <= cnt
-        timeSelected = timeSlots[int(timeNumber) - 1][0]
-        return timeSelected
+        return timeSlots[int(timeNumber) - 1][1:]
+
+    def selectAuditorium(self):
+        """
+        The function prompts the admin to select an auditorium, or to add a new one.
+        
+        Returns the auditoriumID
+        """
+        auditoriums = self.getCursor().selectAll('auditorium')
+        auditoriumTable = PrettyTable(['Auditorium ID', 'Name'])
+        for r in auditoriums:
+            auditoriumTable.add_row(list(r))
+        print(auditoriumTable)
+        while True:
+            auditorium = input('Please enter the auditorium ID, or \'n\' to add a new auditorium: ')
+            if auditorium in (r[0] for r in auditoriums):
+                return auditorium
+            if auditorium.lower() == 'n':
+                break
+            print('Invalid auditorium ID. Please try again.')
+        auditorium = str(max([int(r[0]) for r in auditoriums if r[0].isdigit()] + [0]) + 1)
+        name = input('Enter the name of the new auditorium (e.g. Screen {}): '.format(auditorium)) or 'Screen {}'.format(auditorium)
+        try:
+            with self.getCursor().getConnection():
+                self.getCursor().addAuditorium(auditorium, name)
+        except Error as e:
+            logging.info(e)
+            print('Something is wrong. Please try again.')
+            return self.selectAuditorium()
+        print('Auditorium {} ({}) added!'.format(auditorium, name))
+        logging.info('Auditorium %s (%s) added', auditorium, name)
+        return auditorium
     
     @staticmethod
     def printDate(dateAvailable):
@@ -752,10 +1858,23 @@ class Admin(User):
             filmNum = cml.getCursor().countAll('film')[0][0]
             film = input('Enter the film title: ')
             description = input('Enter the description of the film: ')
-        date = input('Enter the screening date (e.g. 2019/01/01): ')
-        time = input('Enter the screening time (e.g. 09:00): ')
-        columns = ['Film', 'Description', 'Date', 'Time']
-        data = [film, CommandLine.formatMultipleLines(description, 30), date, time]
+        auditorium = cml.selectAuditorium()
+        while True:
+            date = input('Enter the screening date (e.g. 2019/01/01): ')
+            time = input('Enter the screening time (e.g. 09:00): ')
+            duration = input('Enter the running time in minutes (default {}): '.format(Database.defaultDuration)) or str(Database.defaultDuration)
+            try:
+                date, time = Cursor.screeningKey(date, time)
+                overlap = cml.getCursor().findOverlap(auditorium, date, time, int(duration))
+            except ValueError:
+                print('Invalid date, time or running time! Please try again.')
+                continue
+            if overlap is None:
+                break
+            print('Auditorium {} is showing film {} from {} {} until {}. Please choose another time.'.format(auditorium, *overlap))
+            logging.info('Screening at %s %s overlaps %s in auditorium %s', date, time, overlap, auditorium)
+        columns = ['Film', 'Description', 'Date', 'Time', 'Auditorium', 'Minutes']
+        data = [film, CommandLine.formatMultipleLines(description, 30), date, time, auditorium, duration]
         CommandLine.confirmInsert(columns, data, 'Insert Film Confirmation')
         confirm = input('Enter \'Y\' to confirm; enter \'N\' to start again: ')
         confirmValid = confirm.upper() == 'Y' or confirm.upper() == 'N'
@@ -765,24 +1884,19 @@ class Admin(User):
             confirmValid = confirm.upper() == 'Y' or confirm.upper() == 'N'
         if confirm.upper() == 'Y':
             if addItem.lower() == 't':
-                timeError = cml.getCursor().insertScreenTime([date, time, filmID])
-                if not timeError:
-                    seatError = cml.getCursor().insertSeat([filmID, date, time, 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O'])
-                    errorExit = timeError or seatError
-                else:
-                    errorExit = True
+                timeError = cml.getCursor().scheduleScreening(filmID, date, time, auditorium, int(duration))
+                errorExit = timeError
             else:
                 newFilmID = str(filmNum + 1)
                 filmError = cml.getCursor().insertFilm([newFilmID, film, description])
+                timeError = None
                 if not filmError:
-                    timeError = cml.getCursor().insertScreenTime([date, time, newFilmID])
-                    if not timeError:
-                        seatError = cml.getCursor().insertSeat([newFilmID, date, time, 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O', 'O'])
-                    else:
-                        errorExit = True
-                else:
-                    errorExit = True
-                errorExit = filmError or timeError or seatError
+                    timeError = cml.getCursor().scheduleScreening(newFilmID, date, time, auditorium, int(duration))
+                errorExit = filmError or timeError
+            if timeError:
+                print('This time slot is occupied...' if timeError == 'time slot occupied' else 'Error: {}'.format(timeError))
+            elif not errorExit:
+                print('Screening time added!')
             if errorExit:
                 print('Something is wrong. Please try again.')
                 self.addFilm(cml)
@@ -802,13 +1916,14 @@ class Admin(User):
         cml.displayFilm()
         filmID = cml.selectFilm()
         date = cml.selectDate()
-        time = cml.selectTime(date, filmID)
-        if not time:
+        slot = cml.selectTime(date, filmID)
+        if not slot:
             return False
-        condition = 'date = \'{}\' AND time = \'{}\''.format(date, time)
+        time, auditorium = slot
+        condition = 'date = \'{}\' AND time = \'{}\' AND auditorium = \'{}\''.format(date, time, auditorium)
         film = cml.getCursor().selectCondition('film', 'filmID = {}'.format(filmID), 'film')
         bookStatue = cml.getCursor().selectCondition('seats', condition, 'A1', 'A2', 'A3', 'A4', 'A5', 'B1', 'B2', 'B3', 'B4', 'B5', 'C1', 'C2', 'C3', 'C4', 'C5', 'D1', 'D2', 'D3', 'D4', 'D5', 'E1', 'E2', 'E3', 'E4', 'E5')
-        print('\nSeats of \'{}\' screening at {} on {}\n'.format(film[0][0], time, date))
+        print('\nSeats of \'{}\' screening at {} on {} in auditorium {}\n'.format(film[0][0], time, date, auditorium))
         result = cml.displaySeats(bookStatue)
         statusTable = result[0]
         available = result[1]
@@ -819,27 +1934,114 @@ class Admin(User):
     
     def output(self, cml):
         """
-        The function ouputs the film information.
+        The function ouputs the film information, of this site or of every site of the chain.
         
         Parameters:
             cml (CommandLine)
         """
-        condition = 'film.filmID = filmTime.filmID'
-        table = ('film', 'filmTime')
-        column = ('film.filmID', 'film.film', 'filmTime.date', 'filmTime.time')
-        group = ''
-        result = cml.getCursor().selectMulti(condition, table, column, group)
+        router = cml.getRouter()
+        if router and len(router.getSites()) > 1:
+            scope = input('Enter \'s\' to export this site; enter \'c\' to export the whole chain: ')
+            while scope.lower() != 's' and scope.lower() != 'c':
+                print('Invalid input! Please try again.')
+                scope = input('Enter \'s\' to export this site; enter \'c\' to export the whole chain: ')
+            if scope.lower() == 'c':
+                filename = router.exportChain()
+                logging.info('Chain file exported')
+                print('File exported to {}.'.format(filename))
+                return
+        scope = input('Enter \'f\' to export the full schedule; enter \'d\' to export only the screenings changed since the last delta export: ')
+        while scope.lower() != 'f' and scope.lower() != 'd':
+            print('Invalid input! Please try again.')
+            scope = input('Enter \'f\' to export the full schedule; enter \'d\' to export only the screenings changed since the last delta export: ')
+        filename = cml.exportSchedule(consumer = 'reporting' if scope.lower() == 'd' else None)
+        logging.info('File exported')
+        print('File exported to {}.'.format(filename))
+
+    def cancelScreenings(self, cml):
+        """
+        The function cancels one or more screenings at once, releases their seats
+        and exports the list of customers to refund.
+
+        Parameters:
+            cml (CommandLine)
+        """
+        keys = []
+        while True:
+            cml.displayFilm()
+            filmID = cml.selectFilm()
+            date = cml.selectDate()
+            slot = cml.selectTime(date, filmID)
+            if slot and (date,) + slot not in keys:
+                keys.append((date,) + slot)
+            more = input('Enter \'a\' to add another screening; enter \'c\' to continue: ')
+            while more.lower() != 'a' and more.lower() != 'c':
+                print('Invalid input! Please try again.')
+                more = input('Enter \'a\' to add another screening; enter \'c\' to continue: ')
+            if more.lower() == 'c':
+                break
+        if not keys:
+            print('No screening selected.')
+            return
+        confirmTable = PrettyTable(['Screening Date', 'Screening Time', 'Auditorium'])
+        confirmTable.title = 'Cancel Screenings Confirmation'
+        for key in keys:
+            confirmTable.add_row(list(key))
+        print(confirmTable)
+        confirm = input('Enter \'Y\' to confirm; enter \'N\' to return: ')
+        while confirm.upper() != 'Y' and confirm.upper() != 'N':
+            print('Invalid input! Please try again.')
+            confirm = input('Enter \'Y\' to confirm; enter \'N\' to return: ')
+        if confirm.upper() == 'N':
+            return
+        affected = cml.getCursor().cancelScreenings(keys)
+        if affected is Error:
+            print('Something is wrong. No screening was cancelled.')
+            return
+        refundTable = PrettyTable(['Username', 'Name', 'Email', 'Film', 'Screening Date', 'Screening Time', 'Auditorium', 'Seat'])
+        refundTable.title = 'Bookings to Refund'
+        for row in affected:
+            refundTable.add_row([row[0], '{} {}'.format(row[1], row[2]), row[3], CommandLine.formatMultipleLines(row[4], 20), row[5], row[6], row[7], row[8]])
+        print(refundTable)
         outputTime = datetime.datetime.now().strftime('%Y%m%d_%H%M')
-        s = '{}_filmsAndSeats.csv'.format(outputTime)
-        file = open(s, 'w+') # w+ will create a new file if it doesn't exist
-        file.write('filmID, film, date, time, available_seats, booked_seats\n')
-        for row in result:
-            count = cml.countAvailable(row[0], row[2], row[3])
-            file.write('{}, {}, {}, {}, {}, {}\n'.format(row[0], row[1], row[2], row[3], count[0], count[1]))
+        s = '{}_refunds.csv'.format(outputTime)
+        file = open(s, 'w+')
+        file.write('username, firstname, lastname, email, film, date, time, auditorium, seat\n')
+        for row in affected:
+            file.write('{}, {}, {}, {}, {}, {}, {}, {}, {}\n'.format(*row))
         file.close()
-        logging.info('File exported')
-        print('File exported.')
-    
+        print('{} screening(s) cancelled; {} booking(s) to refund exported to {}.'.format(len(keys), len(affected), s))
+        logging.info('Refund list exported to %s', s)
+
+    def showMetrics(self, cml):
+        """
+        The function shows the call counts, query counts and latencies of the operations so far.
+
+        Parameters:
+            cml (CommandLine)
+        """
+        metrics = cml.getMetrics()
+        if metrics is None:
+            print('Metrics are not enabled.')
+            return
+        metricsTable = PrettyTable(['Operation', 'Calls', 'Queries', 'Avg (ms)', 'p95 (ms)', 'Max (ms)'])
+        metricsTable.title = 'Metrics ({} queries in total)'.format(metrics.getQueryCount())
+        for row in metrics.summary():
+            metricsTable.add_row(row)
+        metricsTable.align['Operation'] = 'l'
+        print(metricsTable)
+        profiler = cml.getCursor().getProfiler()
+        if profiler is None:
+            return
+        queryTable = PrettyTable(['Statement', 'Calls', 'Total (ms)', 'Avg (ms)', 'Max (ms)'])
+        queryTable.title = 'Top statements by total time'
+        for row in profiler.summary():
+            queryTable.add_row([CommandLine.formatMultipleLines(row[0], 60)] + row[1:])
+        queryTable.align['Statement'] = 'l'
+        print(queryTable)
+        slow = profiler.getSlowQueries()
+        print('{} statement(s) slower than {:g} ms; see cinema.log for their parameters and query plans.'.format(len(slow), 1000 * profiler.getThreshold()))
+
     @classmethod
     def getTable(cls):
         return cls.table
@@ -875,12 +2077,66 @@ class Customer(User):
         print('    Welcome to the booking system. :D')
         print('-----------------------------------------\n')
         filmID = cml.selectFilm()
-        timeSelected = cml.selectTime(date, filmID)
-        if not timeSelected:
+        slot = cml.selectTime(date, filmID)
+        if not slot:
+            return False
+        return self.enterScreening(filmID, date, slot[0], slot[1], cml)
+
+    def enterScreening(self, filmID, date, timeSelected, auditorium, cml):
+        """
+        The function waits for a turn in the admission queue of a screening and lets the customer choose seats.
+
+        Parameters:
+            filmID (string)
+            date (string)
+            timeSelected (string)
+            auditorium (string)
+            cml (CommandLine)
+        """
+        admission = cml.getAdmission()
+        ticket = admission.enter(self.getUsername(), date, timeSelected, auditorium)
+        try:
+            if not admission.wait(ticket):
+                return False
+            return self.chooseSeats(filmID, date, timeSelected, auditorium, cml)
+        finally:
+            admission.release(ticket)
+
+    def chooseSeats(self, filmID, date, timeSelected, auditorium, cml):
+        """
+        The function shows the seats of a screening and books the ones the customer picks.
+
+        Parameters:
+            filmID (string)
+            date (string)
+            timeSelected (string)
+            auditorium (string)
+            cml (CommandLine)
+
+        Returns False when the customer chooses another screening;
+        returns True when the booking succeed or the customer joins the waitlist.
+        """
+        seatPrices = cml.getCursor().seatPrices(filmID, date, timeSelected, auditorium)
+        if seatPrices is Error:
+            print('The screening is no longer available.\n')
             return False
-        condition = 'filmID = {} AND date = \'{}\' AND time = \'{}\''.format(filmID, date, timeSelected)
-        seat = cml.getCursor().selectCondition('seats', condition, 'A1', 'A2', 'A3', 'A4', 'A5', 'B1', 'B2', 'B3', 'B4', 'B5', 'C1', 'C2', 'C3', 'C4', 'C5', 'D1', 'D2', 'D3', 'D4', 'D5', 'E1', 'E2', 'E3', 'E4', 'E5')
-        cml.displaySeats(seat)
+        seats, prices = seatPrices
+        available = cml.displaySeats([seats])[1]
+        print('Prices: ' + '; '.join('{} (rows {}) £{:.2f}'.format(zone[0], ' '.join(zone[1]), price) for zone, price in zip(Database.priceZone, prices)) + '\n')
+        if available == 0:
+            print('This screening is sold out.')
+            join = input('Enter \'w\' to join the waitlist; enter \'n\' to find the next screenings with free seats; enter \'r\' to choose another screening: ')
+            while join.lower() != 'w' and join.lower() != 'n' and join.lower() != 'r':
+                print('Invalid input! Please try again.')
+                join = input('Enter \'w\' to join the waitlist; enter \'n\' to find the next screenings with free seats; enter \'r\' to choose another screening: ')
+            if join.lower() == 'r':
+                return False
+            if join.lower() == 'n':
+                screening = self.findScreening(filmID, date, timeSelected, cml)
+                if not screening:
+                    return False
+                return self.enterScreening(filmID, screening[0], screening[1], screening[2], cml)
+            return self.joinWaitlist(filmID, date, timeSelected, auditorium, cml)
         bookSucceed = False
         while not bookSucceed:
             seatsWanted = input('Please enter the seats you want to book (e.g., B3 B4): ')
@@ -891,33 +2147,173 @@ class Customer(User):
                     logging.info('Invalid input! Out of seat range.')
                     break
             else: # if all the seats wanted have the right format (doesn't break)
-                occupied = False
-                occupiedSeat = []
-                for i in splitInput:
-                    seatStatus = cml.getCursor().selectCondition('seats', condition, i)
-                    if seatStatus[0][0] == 'X':
-                        occupied = True
-                        occupiedSeat.append(i)
-                if occupied:
+                occupiedSeat = cml.getCursor().makeBooking(self.getUsername(), filmID, date, timeSelected, auditorium, splitInput)
+                if occupiedSeat is Error:
+                    print('Something is wrong. Please try again.')
+                    return False
+                if occupiedSeat:
                     print(', '.join(i for i in occupiedSeat), end = '')
                     print(' is/are not available. Please try again.')
                     logging.info('Seat(s) is/are occupied')
                     continue
-                else: # inputs are valid and not occupied
-                    for i in splitInput:
-                        cml.getCursor().updateData('seats', filmID, 'filmID', i, 'X') # update the booked seat
-                    currentTime = datetime.datetime.now()
-                    formattedCurrentTime = currentTime.strftime('%Y/%m/%d %H:%M')
-                    data = (formattedCurrentTime, self.getUsername(), filmID, date, timeSelected, seatsWanted)
-                    cml.getCursor().insertBooking(data)
-                    logging.info('%s (filmID) on %s at %s %s is/are booked', filmID, date, timeSelected, seatsWanted)
-                    bookSucceed = True
+                logging.info('%s (filmID) on %s at %s in auditorium %s %s is/are booked', filmID, date, timeSelected, auditorium, seatsWanted)
+                bookSucceed = True
+        print('Successfully booked!')
+        bookingSummary = PrettyTable(['FilmID', 'Screening Date', 'Screening Time', 'Auditorium', 'Seat', 'Price'])
+        bookingSummary.title = 'Booking Summary'
+        bookingSummary.add_row([filmID, date, timeSelected, auditorium, seatsWanted, '£{:.2f}'.format(sum(prices[Database.seatZone[i[0]]] for i in splitInput))])
+        print(bookingSummary)
+        return True
+
+    def findScreening(self, filmID, date, time, cml):
+        """
+        The function lists the next screenings of a film with enough (adjacent) free seats after a sold-out one,
+        and lets the customer pick one.
+
+        Parameters:
+            filmID (string)
+            date (string)
+            time (string)
+            cml (CommandLine)
+
+        Returns the (date, time, auditorium) picked, or None.
+        """
+        seatNum = input('How many seats do you need? ')
+        while not seatNum.isdigit() or int(seatNum) < 1 or int(seatNum) > 25:
+            print('Invalid input! Please enter 1 - 25.')
+            seatNum = input('How many seats do you need? ')
+        together = input('Do the seats need to be next to each other? (y/n) ')
+        while together.lower() != 'y' and together.lower() != 'n':
+            print('Invalid input! Please try again.')
+            together = input('Do the seats need to be next to each other? (y/n) ')
+        result = cml.getCursor().nextScreenings(int(seatNum), filmID, together.lower() == 'y', (date, time))
+        if not result:
+            print('There is no later screening with {} free seat(s){}.'.format(seatNum, ' together' if together.lower() == 'y' else ''))
+            return None
+        screeningTable = PrettyTable(['No.', 'Film', 'Screening Date', 'Screening Time', 'Auditorium', 'Free Seats', 'Most Seats Together'])
+        for number, row in enumerate(result, 1):
+            screeningTable.add_row([number, CommandLine.formatMultipleLines(row[1], 30), row[2], row[3], row[4], row[5], row[6]])
+        print(screeningTable)
+        logging.info('\n' + str(screeningTable))
+        choice = input('Please enter the No. of the screening to book; enter \'r\' to return: ')
+        while choice.lower() != 'r' and not (choice.isdigit() and 1 <= int(choice) <= len(result)):
+            print('Invalid input! Please try again.')
+            choice = input('Please enter the No. of the screening to book; enter \'r\' to return: ')
+        if choice.lower() == 'r':
+            return None
+        return result[int(choice) - 1][2:5]
+
+    def cart(self, cml):
+        """
+        The function collects seats at several screenings and books them all at once, or none of them.
+
+        Parameters:
+            cml (CommandLine)
+
+        Returns True when the cart is booked.
+        """
+        cart = []
+        adding = True
+        while True:
+            slot = None
+            if adding:
+                selectedDate = cml.displayFilms()
+                filmID = cml.selectFilm()
+                slot = cml.selectTime(selectedDate, filmID)
+            if slot:
+                timeSelected, auditorium = slot
+                if any(item[1:4] == (selectedDate, timeSelected, auditorium) for item in cart):
+                    print('This screening is in your cart already.')
+                else:
+                    condition = 'filmID = {} AND date = \'{}\' AND time = \'{}\' AND auditorium = \'{}\''.format(filmID, selectedDate, timeSelected, auditorium)
+                    cml.displaySeats(cml.getCursor().selectCondition('seats', condition, *Database.seatColumn))
+                    seatsWanted = input('Please enter the seats you want to book (e.g., B3 B4): ')
+                    while not all(CommandLine.checkSeatInput(i) for i in seatsWanted.split(' ')):
+                        print('Invalid input! Please enter A1 - E5.')
+                        seatsWanted = input('Please enter the seats you want to book (e.g., B3 B4): ')
+                    cart.append((filmID, selectedDate, timeSelected, auditorium, seatsWanted.split(' ')))
+            cartTable = PrettyTable(['FilmID', 'Screening Date', 'Screening Time', 'Auditorium', 'Seat'])
+            cartTable.title = 'Cart'
+            for item in cart:
+                cartTable.add_row([item[0], item[1], item[2], item[3], ' '.join(item[4])])
+            print(cartTable)
+            action = input('Enter \'a\' to add another screening; enter \'c\' to check out; enter \'q\' to empty the cart and return: ')
+            while action.lower() != 'a' and action.lower() != 'c' and action.lower() != 'q':
+                print('Invalid input! Please try again.')
+                action = input('Enter \'a\' to add another screening; enter \'c\' to check out; enter \'q\' to empty the cart and return: ')
+            if action.lower() == 'q':
+                return False
+            adding = action.lower() == 'a' or not cart
+            if adding:
+                continue
+            conflicts = cml.getCursor().checkoutCart(self.getUsername(), cart)
+            if conflicts is Error:
+                print('Something is wrong. Please try again.')
+                continue
+            if not conflicts:
+                break
+            print('Nothing was booked, because of these conflicts:')
+            conflictTable = PrettyTable(['FilmID', 'Screening Date', 'Screening Time', 'Auditorium', 'Problem'])
+            for filmID, date, time, auditorium, occupied in conflicts:
+                conflictTable.add_row([filmID, date, time, auditorium, 'screening unavailable' if occupied is None else ', '.join(occupied) + ' taken'])
+            print(conflictTable)
+            print('The screenings with conflicts were removed from your cart.')
+            cart = [item for item in cart if not any(item[1:4] == tuple(i[1:4]) for i in conflicts)]
+            adding = False
         print('Successfully booked!')
-        bookingSummary = PrettyTable(['FilmID', 'Screening Date', 'Screening Time', 'Seat'])
+        bookingSummary = PrettyTable(['FilmID', 'Screening Date', 'Screening Time', 'Auditorium', 'Seat'])
         bookingSummary.title = 'Booking Summary'
-        bookingSummary.add_row([filmID, date, timeSelected, seatsWanted])
+        for item in cart:
+            bookingSummary.add_row([item[0], item[1], item[2], item[3], ' '.join(item[4])])
         print(bookingSummary)
+        logging.info('%s booked a cart of %d screening(s)', self.getUsername(), len(cart))
+        return True
+
+    def joinWaitlist(self, filmID, date, time, auditorium, cml):
+        """
+        The function puts the customer on the waitlist of a sold-out screening.
+
+        Parameters:
+            filmID (string)
+            date (string)
+            time (string)
+            auditorium (string)
+            cml (CommandLine)
+
+        Returns True when the customer is on the waitlist.
+        """
+        seatNum = input('How many seats do you need? ')
+        while not seatNum.isdigit() or int(seatNum) < 1 or int(seatNum) > 25:
+            print('Invalid input! Please enter 1 - 25.')
+            seatNum = input('How many seats do you need? ')
+        formattedCurrentTime = datetime.datetime.now().strftime('%Y/%m/%d %H:%M')
+        data = (formattedCurrentTime, self.getUsername(), filmID, date, time, auditorium, int(seatNum))
+        if cml.getCursor().insertWaitlist(data):
+            print('Something is wrong. Please try again.')
+            return False
+        print('You are on the waitlist. The seats will be booked for you as soon as they are released.')
+        logging.info('%s joined the waitlist of %s (filmID) on %s at %s in auditorium %s', self.getUsername(), filmID, date, time, auditorium)
         return True
+
+    def checkWaitlist(self, cml):
+        """
+        The function tells the customer about waitlisted bookings that were confirmed since the last login.
+
+        Parameters:
+            cml (CommandLine)
+        """
+        condition = 'username = \'{}\' AND status = \'booked\' AND film.filmID = waitlist.filmID'.format(self.getUsername())
+        table = ('film', 'waitlist')
+        column = ('film.film', 'waitlist.date', 'waitlist.time', 'waitlist.auditorium', 'waitlist.seat')
+        promoted = cml.getCursor().selectMulti(condition, table, column, '')
+        if not promoted:
+            return
+        promotedTable = PrettyTable(['Film', 'Screening Date', 'Screening Time', 'Auditorium', 'Seat'])
+        promotedTable.title = 'Booked From Your Waitlist'
+        for i in promoted:
+            promotedTable.add_row([CommandLine.formatMultipleLines(i[0], 20), i[1], i[2], i[3], i[4]])
+        print(promotedTable)
+        cml.getCursor().markNotified(self.getUsername())
     
     def updateProfile(self, cml):
         """
@@ -975,25 +2371,30 @@ class Customer(User):
             if keepUpdate.lower() == 'u':
                 self.updateProfile(cml)
                 
-    def bookingHistory(self, cml):
+    def bookingHistory(self, cml, includeArchive = False):
         """
         The function shows the booking history of a customer.
         
         Parameters:
             cml (CommandLine)
+            includeArchive (bool): also read the bookings of archived screenings
             
         Returns the list 'history' the database returned
         """
         username = self.getUsername()
         condition = 'username = \'{}\' AND film.filmID = booking.filmID'.format(username)
         table = ('film', 'booking')
-        column = ('film.film', 'booking.date', 'booking.time', 'booking.seat')
+        column = ('film.film', 'booking.date', 'booking.time', 'booking.seat', 'booking.auditorium')
         group = ''
         history = cml.getCursor().selectMulti(condition, table, column, group)
-        historyTable = PrettyTable(['BookingID', 'Film', 'Screening Date', 'Screening Time', 'Seat'])
+        if includeArchive:
+            cml.getCursor().useArchive()
+            archived = cml.getCursor().selectMulti(condition, ('film', 'archive.booking AS booking'), column, group)
+            history = (archived or []) + history
+        historyTable = PrettyTable(['BookingID', 'Film', 'Screening Date', 'Screening Time', 'Auditorium', 'Seat'])
         historyTable.title = '{}\'s Booking History'.format(username)
         for cnt, i in zip(range(1, len(history) + 1), history):
-            historyTable.add_row([cnt, i[0], i[1], i[2], i[3]])
+            historyTable.add_row([cnt, i[0], i[1], i[2], i[4], i[3]])
         print(historyTable)
         return history
     
@@ -1037,10 +2438,13 @@ class Customer(User):
                 print('You can only change a future booking.')
                 return
             else:
-                condition = 'username = \'{}\' AND date = \'{}\' AND time = \'{}\' AND seat = \'{}\''.format(self.getUsername(), date, time, history[intBookingID - 1][3])
-                cml.getCursor().deleteRow('booking', condition)
+                promoted = cml.getCursor().releaseBooking(self.getUsername(), date, time, history[intBookingID - 1][4], history[intBookingID - 1][3])
+                if promoted is Error:
+                    print('Something is wrong. Please try again.')
+                    return
                 print('Booking deleted!')
-                cml.getCursor().updateSeat((date, time), (history[intBookingID - 1][3].split(' ')))
+                if promoted:
+                    logging.info('%d waitlisted booking(s) promoted', len(promoted))
         else: # no booking
             print('You have no booking history...')
     
@@ -1056,14 +2460,1149 @@ class Customer(User):
     def checkPassword(cls, un, pw, cursor):
         return super().checkPassword(un, pw, cls.table, cursor)
  
+class SeatFeed:
+    """
+    Publishes seat changes to subscribers once the transaction that made them is committed.
+    Each event is a dict {'seq', 'filmID', 'date', 'time', 'auditorium', 'seats', 'state'}, where 'seats'
+    is a list of seat names and 'state' is 'O' or 'X'.
+    """
+    def __init__(self):
+        self._subscribers = []
+        self._pending = []
+        self._seq = 0
+
+    def subscribe(self, callback):
+        """
+        The function registers 'callback', which is called with every event.
+        """
+        self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def hasSubscribers(self):
+        return bool(self._subscribers)
+
+    def stage(self, filmID, date, time, auditorium, seats, state):
+        """
+        The function records a seat change of the current transaction; it is ignored if nobody is listening.
+        """
+        if self._subscribers and seats:
+            self._pending.append({'filmID': str(filmID), 'date': date, 'time': time, 'auditorium': auditorium, 'seats': list(seats), 'state': state})
+
+    def mark(self):
+        return len(self._pending)
+
+    def discard(self, mark = 0):
+        """
+        The function drops the changes staged after 'mark' because their transaction was rolled back.
+        """
+        del self._pending[mark:]
+
+    def flush(self):
+        """
+        The function publishes the staged changes once their transaction is committed.
+        """
+        pending = self._pending
+        self._pending = []
+        for event in pending:
+            self._seq += 1
+            event['seq'] = self._seq
+            for callback in list(self._subscribers):
+                try:
+                    callback(event)
+                except Exception as e: # a broken subscriber must not break booking
+                    logging.info('Seat feed subscriber failed: %s', e)
+
+class SeatFeedServer:
+    """
+    Streams the events of a SeatFeed to local clients over TCP, one JSON line per event.
+    A new client first receives a snapshot line per screening ({'filmID', 'date', 'time', 'auditorium', 'seatMap'}),
+    then every change from the moment it connected.
+    Publishing only queues the event for each client; every client has its own thread that sends its queue,
+    so a slow display never delays a booking commit. A client more than 'queueLimit' events behind is dropped.
+    """
+    queueLimit = 10000 # events a client may fall behind
+
+    def __init__(self, feed, filename, port):
+        self._filename = filename
+        self._clients = []
+        self._lock = threading.Lock()
+        import socket # only the feed server and its clients use sockets
+        self._server = socket.create_server(('127.0.0.1', port))
+        feed.subscribe(self.publish)
+        threading.Thread(target = self.serve, daemon = True).start()
+        logging.info('Seat feed listening on 127.0.0.1:%d', port)
+
+    def serve(self):
+        """
+        The function accepts clients until the server is closed.
+        """
+        import queue
+        while True:
+            try:
+                connection, address = self._server.accept()
+            except OSError:
+                return
+            connection.settimeout(1) # a stuck display is dropped by its own thread
+            client = {'connection': connection, 'lines': queue.Queue(self.queueLimit), 'dropped': False}
+            with self._lock: # registered before the snapshot is read, so no change is missed
+                self._clients.append(client)
+            threading.Thread(target = self.send, args = (client,), daemon = True).start()
+
+    def send(self, client):
+        """
+        The function sends the snapshot to a new client, then the changes queued for it, until it is dropped.
+        """
+        connection = client['connection']
+        seatColumns = Database.seatColumn
+        try:
+            snapshotConnection = sqlite3.connect(self._filename)
+            try:
+                lines = []
+                for row in snapshotConnection.execute('SELECT filmID, date, time, auditorium, ' + ', '.join(seatColumns) + ' FROM seats;'):
+                    lines.append(json.dumps({'filmID': row[0], 'date': row[1], 'time': row[2], 'auditorium': row[3], 'seatMap': ''.join(row[4:])}) + '\n')
+            finally:
+                snapshotConnection.close()
+            connection.sendall(''.join(lines).encode())
+            while True:
+                line = client['lines'].get()
+                if line is None or client['dropped']:
+                    break
+                connection.sendall(line.encode())
+        except (OSError, Error) as e:
+            logging.info('Seat feed client dropped: %s', e)
+        self.drop(client)
+
+    def publish(self, event):
+        """
+        The function queues one event for every client, without waiting for any of them.
+        """
+        line = json.dumps(event) + '\n'
+        with self._lock:
+            for client in list(self._clients):
+                if client['lines'].full():
+                    logging.info('Seat feed client dropped: %d events behind', self.queueLimit)
+                    self._clients.remove(client)
+                    client['dropped'] = True
+                else:
+                    client['lines'].put_nowait(line)
+
+    def drop(self, client):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+            client['dropped'] = True
+            if not client['lines'].full():
+                client['lines'].put_nowait(None) # wakes its thread if it is waiting for a change
+        client['connection'].close()
+
+    def close(self):
+        self._server.close()
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            self.drop(client)
+
+class SeatMap:
+    """
+    A compact seat map for caching hot screenings: one bit per seat in a bytearray (1 = taken),
+    with the number of taken seats kept up to date so availability is O(1).
+    Seats are addressed by index or by name ('A1' ... 'E5').
+    """
+    __slots__ = ('_bits', '_size', '_taken')
+    seatIndex = {seat: i for i, seat in enumerate(Database.seatColumn)}
+
+    def __init__(self, size = len(seatIndex)):
+        self._bits = bytearray((size + 7) // 8)
+        self._size = size
+        self._taken = 0
+
+    @classmethod
+    def fromString(cls, statuses):
+        """
+        The function builds a seat map from 'O'/'X' statuses, e.g. a row of the table 'seats' without its key.
+        """
+        seatMap = cls(len(statuses))
+        for i, status in enumerate(statuses):
+            if status == 'X':
+                seatMap.set(i, True)
+        return seatMap
+
+    @classmethod
+    def fromBytes(cls, data):
+        """
+        The function rebuilds a seat map written by 'toBytes'.
+        """
+        seatMap = cls(int.from_bytes(data[:2], 'big'))
+        seatMap._bits[:] = data[2:]
+        seatMap._taken = bin(int.from_bytes(seatMap._bits, 'big')).count('1')
+        return seatMap
+
+    def toBytes(self):
+        """
+        The function serialises the seat map as 2 bytes of size followed by the bits.
+        """
+        return self._size.to_bytes(2, 'big') + bytes(self._bits)
+
+    def index(self, seat):
+        return SeatMap.seatIndex[seat] if isinstance(seat, str) else seat
+
+    def isTaken(self, seat):
+        i = self.index(seat)
+        return bool(self._bits[i >> 3] & (1 << (i & 7)))
+
+    def set(self, seat, taken):
+        """
+        The function marks one seat as taken (True) or available (False).
+        """
+        i = self.index(seat)
+        mask = 1 << (i & 7)
+        if bool(self._bits[i >> 3] & mask) == taken:
+            return
+        self._bits[i >> 3] ^= mask
+        self._taken += 1 if taken else -1
+
+    def taken(self):
+        return self._taken
+
+    def available(self):
+        return self._size - self._taken
+
+    def __len__(self):
+        return self._size
+
+    def __str__(self):
+        return ''.join('X' if self.isTaken(i) else 'O' for i in range(self._size))
+
+class LiveSeatMap:
+    """
+    A local copy of the seat maps kept current by seat feed events, e.g. for a lobby display.
+    Use 'seatMap.load(cursor)' and 'feed.subscribe(seatMap.apply)' in the same process, or 'seatMap.follow(port)' over the socket stream.
+    """
+    def __init__(self):
+        self._screenings = {} # (date, time, auditorium) -> (filmID, SeatMap)
+
+    def load(self, cursor):
+        """
+        The function takes the current seat maps from the database, before subscribing in the same process.
+
+        Parameters:
+            cursor (Cursor)
+        """
+        for row in cursor.selectAll('seats'):
+            self._screenings[(row[1], row[2], row[3])] = (row[0], SeatMap.fromString(row[4:]))
+
+    def apply(self, event):
+        """
+        The function applies a snapshot line or a seat change event.
+        """
+        key = (event['date'], event['time'], event['auditorium'])
+        if 'seatMap' in event:
+            self._screenings[key] = (event['filmID'], SeatMap.fromString(event['seatMap']))
+            return
+        screening = self._screenings.setdefault(key, (event['filmID'], SeatMap()))
+        taken = event['state'] == 'X'
+        for seat in event['seats']:
+            screening[1].set(seat, taken)
+
+    def available(self, date, time, auditorium):
+        """
+        The function returns the number of available seats of a screening, or None if it is unknown.
+        """
+        screening = self._screenings.get((date, time, auditorium))
+        if screening is None:
+            return None
+        return screening[1].available()
+
+    def seats(self, date, time, auditorium):
+        screening = self._screenings.get((date, time, auditorium))
+        return screening and str(screening[1])
+
+    def follow(self, port, callback = None):
+        """
+        The function connects to a SeatFeedServer and applies its lines until the connection closes.
+
+        Parameters:
+            port (int)
+            callback (function): called with (date, time, auditorium) after each change, e.g. to redraw a display
+        """
+        import socket
+        with socket.create_connection(('127.0.0.1', port)) as connection:
+            for line in connection.makefile('r'):
+                event = json.loads(line)
+                self.apply(event)
+                if callback:
+                    callback(event['date'], event['time'], event['auditorium'])
+
+def seatMapBenchmark(screenings = 500, seats = 400):
+    """
+    The function compares the memory used to cache 'screenings' seat maps of 'seats' seats each
+    as tuples of 'O'/'X' strings (as returned by sqlite) and as SeatMap objects.
+
+    Returns (bytes for the tuples, bytes for the SeatMaps)
+    """
+    import random
+    import tracemalloc
+    statuses = [[random.choice('OX') for i in range(seats)] for j in range(screenings)]
+    results = []
+    for build in (tuple, SeatMap.fromString):
+        tracemalloc.start()
+        cache = [build(row) for row in statuses]
+        results.append(tracemalloc.get_traced_memory()[0])
+        tracemalloc.stop()
+        del cache
+    return tuple(results)
+
+class Metrics:
+    """
+    Call counts, query counts and latency histograms of the instrumented operations.
+    Queries are counted through the sqlite trace callback, so every statement is counted,
+    including those of nested operations. Only the work of the system is timed: the Cursor methods
+    behind each menu action (e.g. Customer.chooseSeats -> Cursor.makeBooking) and the exports and reports
+    that run without prompting, never a method that waits for the user's input.
+    """
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30) # seconds, plus +Inf
+    cursorOperations = [name for name, value in Cursor.__dict__.items() if callable(value) and not name.startswith(('_', 'get'))]
+    userOperations = {'CommandLine': ('exportSchedule',), # by class name, as SiteRouter is defined further down
+                      'Customer': ('bookingHistory', 'checkWaitlist'),
+                      'SiteRouter': ('exportChain',)}
+    active = None # the Metrics the instrumented methods record to
+
+    def __init__(self):
+        self._operations = {} # name -> [calls, queries, total seconds, max seconds, bucket counts]
+        self._queries = 0
+        self._lock = threading.Lock()
+
+    def countQuery(self, statement):
+        """
+        The function is the trace callback of the connection; it counts every statement executed.
+        """
+        self._queries += 1
+
+    def getQueryCount(self):
+        return self._queries
+
+    def observe(self, name, seconds, queries):
+        """
+        The function records one call of an operation.
+        """
+        with self._lock:
+            record = self._operations.get(name)
+            if record is None:
+                record = self._operations[name] = [0, 0, 0.0, 0.0, [0] * (len(Metrics.buckets) + 1)]
+            record[0] += 1
+            record[1] += queries
+            record[2] += seconds
+            record[3] = max(record[3], seconds)
+            record[4][bisect.bisect_left(Metrics.buckets, seconds)] += 1
+
+    @staticmethod
+    def timed(name, function):
+        """
+        The function wraps 'function' so that each call is recorded under 'name' by Metrics.active.
+        """
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            metrics = Metrics.active
+            queries = metrics._queries
+            start = timeModule.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metrics.observe(name, timeModule.perf_counter() - start, metrics._queries - queries)
+        return wrapper
+
+    def instrument(self):
+        """
+        The function makes this Metrics record the Cursor methods and the operations in 'userOperations'.
+        The classes are patched once per process; a later call only moves the records to its Metrics.
+        """
+        if Metrics.active is None:
+            for name in Metrics.cursorOperations:
+                setattr(Cursor, name, Metrics.timed('Cursor.' + name, Cursor.__dict__[name]))
+            for className, names in Metrics.userOperations.items():
+                cls = globals()[className]
+                for name in names:
+                    setattr(cls, name, Metrics.timed(className + '.' + name, cls.__dict__[name]))
+        Metrics.active = self
+
+    def summary(self):
+        """
+        The function returns one row per operation: name, calls, queries, average, p95 and max latency in ms.
+        The p95 is the upper bound of the histogram bucket it falls in.
+        """
+        rows = []
+        with self._lock:
+            for name, (calls, queries, total, longest, counts) in sorted(self._operations.items()):
+                rank = 0.95 * calls
+                seen = 0
+                p95 = longest
+                for bound, count in zip(Metrics.buckets, counts):
+                    seen += count
+                    if seen >= rank:
+                        p95 = min(bound, longest)
+                        break
+                rows.append([name, calls, queries, round(1000 * total / calls, 2), round(1000 * p95, 2), round(1000 * longest, 2)])
+        return rows
+
+    def prometheus(self):
+        """
+        The function returns the metrics in the Prometheus text format.
+        """
+        lines = ['# HELP cinema_operation_seconds Latency of cinema operations.',
+                 '# TYPE cinema_operation_seconds histogram']
+        with self._lock:
+            operations = sorted((name, list(record[:4]) + [list(record[4])]) for name, record in self._operations.items())
+        for name, (calls, queries, total, longest, counts) in operations:
+            cumulative = 0
+            for bound, count in zip(Metrics.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('cinema_operation_seconds_bucket{{operation="{}",le="{}"}} {}'.format(name, bound, cumulative))
+            lines.append('cinema_operation_seconds_sum{{operation="{}"}} {}'.format(name, total))
+            lines.append('cinema_operation_seconds_count{{operation="{}"}} {}'.format(name, calls))
+        lines += ['# HELP cinema_operation_queries_total SQL statements issued by cinema operations.',
+                  '# TYPE cinema_operation_queries_total counter']
+        for name, record in operations:
+            lines.append('cinema_operation_queries_total{{operation="{}"}} {}'.format(name, record[1]))
+        lines += ['# HELP cinema_queries_total SQL statements issued.',
+                  '# TYPE cinema_queries_total counter',
+                  'cinema_queries_total {}'.format(self._queries)]
+        return '\n'.join(lines) + '\n'
+
+    def writePrometheus(self, filename):
+        """
+        The function writes the metrics to 'filename', replacing it atomically for the scraper.
+        """
+        temporary = filename + '.tmp'
+        with open(temporary, 'w') as file:
+            file.write(self.prometheus())
+        os.replace(temporary, filename)
+
+    def startExport(self, filename, interval):
+        """
+        The function writes the Prometheus file every 'interval' seconds in a background thread.
+        """
+        def export():
+            while True:
+                timeModule.sleep(interval)
+                try:
+                    self.writePrometheus(filename)
+                except OSError as e:
+                    logging.info('Metrics export failed: %s', e)
+        threading.Thread(target = export, daemon = True).start()
+
+class ProfiledCursor(sqlite3.Cursor):
+    """
+    A sqlite3 cursor that reports the duration of every statement to a QueryProfiler.
+    SQLite computes the rows of a query as they are fetched, so the time spent in fetchone, fetchmany,
+    fetchall and iteration is added to the statement, which is recorded once its rows are exhausted,
+    or when the cursor runs the next statement or is closed.
+    """
+    def __init__(self, connection, profiler):
+        super().__init__(connection)
+        self._profiler = profiler
+        self._pending = None # [statement, parameters, seconds] of the query whose rows are being read
+
+    def execute(self, sql, parameters = ()):
+        self.finish()
+        start = timeModule.perf_counter()
+        try:
+            result = super().execute(sql, parameters)
+        except Exception:
+            self._profiler.record(self.connection, sql, parameters, timeModule.perf_counter() - start)
+            raise
+        self._pending = [sql, parameters, timeModule.perf_counter() - start]
+        if self.description is None: # no rows to read
+            self.finish()
+        return result
+
+    def fetchone(self):
+        start = timeModule.perf_counter()
+        row = super().fetchone()
+        self.elapse(start, row is None)
+        return row
+
+    def fetchmany(self, size = None):
+        size = self.arraysize if size is None else size
+        start = timeModule.perf_counter()
+        rows = super().fetchmany(size)
+        self.elapse(start, len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        start = timeModule.perf_counter()
+        rows = super().fetchall()
+        self.elapse(start, True)
+        return rows
+
+    def __next__(self):
+        start = timeModule.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self.elapse(start, True)
+            raise
+        self.elapse(start, False)
+        return row
+
+    def close(self):
+        self.finish()
+        super().close()
+
+    def elapse(self, start, exhausted):
+        """
+        The function adds the time since 'start' to the pending query, and records it if its rows are exhausted.
+        """
+        if self._pending is not None:
+            self._pending[2] += timeModule.perf_counter() - start
+            if exhausted:
+                self.finish()
+
+    def finish(self):
+        """
+        The function records the pending query, if any.
+        """
+        pending = self._pending
+        self._pending = None
+        if pending is not None:
+            self._profiler.record(self.connection, *pending)
+
+    def executemany(self, sql, parameters):
+        self.finish()
+        parameters = list(parameters)
+        start = timeModule.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            self._profiler.record(self.connection, sql, parameters[0] if parameters else (), timeModule.perf_counter() - start, len(parameters))
+
+class QueryProfiler:
+    """
+    Times every statement of the Cursors it is set on (see Cursor.setProfiler).
+    Statements are grouped with their literals replaced by '?', so queries built by string formatting add up.
+    A statement slower than 'threshold' seconds is logged and kept, with its bound parameters and its EXPLAIN QUERY PLAN.
+    """
+    literal = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+    def __init__(self, threshold = 0.05, keep = 100):
+        self._threshold = threshold
+        self._keep = keep
+        self._statements = {} # normalised statement -> [calls, total seconds, max seconds]
+        self._slow = [] # (seconds, statement, parameters, plan), the latest 'keep'
+        self._lock = threading.Lock()
+
+    def getThreshold(self):
+        return self._threshold
+
+    def getSlowQueries(self):
+        with self._lock:
+            return list(self._slow)
+
+    def record(self, connection, statement, parameters, seconds, rows = 1):
+        """
+        The function records one execution of a statement, explaining it if it is slow.
+
+        Parameters:
+            connection (sqlite3.Connection): the connection that ran the statement
+            statement (string)
+            parameters (tuple or dict): the bound parameters (of the first row for executemany)
+            seconds (float)
+            rows (int): the number of parameter rows for executemany
+        """
+        key = ' '.join(QueryProfiler.literal.sub('?', statement).split())
+        with self._lock:
+            record = self._statements.get(key)
+            if record is None:
+                record = self._statements[key] = [0, 0.0, 0.0]
+            record[0] += rows
+            record[1] += seconds
+            record[2] = max(record[2], seconds)
+        if seconds < self._threshold:
+            return
+        plan = self.explain(connection, statement, parameters)
+        logging.info('Slow query (%.1f ms): %s -- parameters: %r -- plan: %s', 1000 * seconds, statement, parameters, ' | '.join(plan))
+        with self._lock:
+            self._slow.append((seconds, statement, parameters, plan))
+            del self._slow[:-self._keep]
+
+    def explain(self, connection, statement, parameters):
+        """
+        The function returns the EXPLAIN QUERY PLAN of a statement as a list of lines, empty if it cannot be explained.
+        """
+        if statement.lstrip().split(' ', 1)[0].upper() not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE'):
+            return []
+        try:
+            c = sqlite3.Cursor(connection) # a plain cursor, so explaining is not profiled itself
+            c.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            return [row[3] for row in c.fetchall()]
+        except Error as e:
+            return ['cannot explain: {}'.format(e)]
+
+    def summary(self, limit = 10):
+        """
+        The function returns the statements that took the most time in total:
+        one row per statement with the statement, calls, total, average and max time in ms.
+        """
+        with self._lock:
+            statements = sorted(self._statements.items(), key = lambda item: item[1][1], reverse = True)[:limit]
+        return [[statement, calls, round(1000 * total, 2), round(1000 * total / calls, 3), round(1000 * longest, 2)]
+                for statement, (calls, total, longest) in statements]
+
+    def logSummary(self, limit = 10):
+        """
+        The function writes the summary of the top statements to the log.
+        """
+        for statement, calls, total, average, longest in self.summary(limit):
+            logging.info('Query total %.2f ms, %d call(s), avg %.3f ms, max %.2f ms: %s', total, calls, average, longest, statement)
+
+class AdmissionController:
+    """
+    A virtual queue in front of the booking path. At most 'sessionLimit' customers per screening
+    are admitted to pick seats at the same time; the others wait in first in, first out order.
+    The queue is kept in its own database file (Database.getQueueFilename), so it is shared by every
+    process using the site but never takes the write lock of the booking database.
+    Polling only reads; a ticket writes when it enters, is admitted or leaves, and refreshes its place
+    every 'waitTimeout' / 2 seconds.
+    """
+    sessionLimit = 5 # booking sessions per screening
+    sessionTimeout = 300 # seconds an admitted session may hold its place
+    waitTimeout = 10 # seconds a waiting ticket survives without polling
+    pollInterval = 1 # seconds between polls
+    defaultDuration = 60 # seconds per session assumed before any session finished
+    history = 3600 # seconds finished sessions are kept for 'estimateWait'
+    schema = ('CREATE TABLE IF NOT EXISTS admission (ticket integer primary key autoincrement, username text, date text, time text, auditorium text, '
+              'status text, seen real, admitted real, finished real);',
+              'CREATE INDEX IF NOT EXISTS admissionQueue ON admission (auditorium, date, time, status, ticket);')
+
+    def __init__(self, cursor, sessionLimit = None):
+        self._cursor = cursor
+        self._connection = None
+        if sessionLimit is not None:
+            self.sessionLimit = sessionLimit
+
+    def getCursor(self):
+        return self._cursor
+
+    def getConnection(self):
+        """
+        The function returns the connection to the queue database, opening it and creating its table on first use.
+        """
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.getCursor().getDatabase().getQueueFilename(), timeout = 1)
+            for s in self.schema:
+                self._connection.execute(s)
+                logging.info(s)
+            self._connection.commit()
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def enter(self, username, date, time, auditorium):
+        """
+        The function takes a ticket for a screening, and deletes the tickets that can no longer be admitted
+        in the same transaction (see 'purge').
+
+        Returns the ticket number
+        """
+        connection = self.getConnection()
+        with connection:
+            self.purge()
+            s = 'INSERT INTO admission (username, date, time, auditorium, status, seen) VALUES (?, ?, ?, ?, \'waiting\', ?);'
+            ticket = connection.execute(s, (username, date, time, auditorium, timeModule.time())).lastrowid
+            logging.info(s)
+        return ticket
+
+    def poll(self, ticket):
+        """
+        The function admits the ticket if it is its turn. The queue is read without a lock, and only
+        an admission takes the write lock of the queue database, rechecking the counts inside it.
+        Tickets that stopped polling and sessions that overran 'sessionTimeout' do not hold a place.
+
+        Returns (status, position, estimated wait in seconds); status is 'admitted', 'waiting' or 'expired'
+        """
+        connection = self.getConnection()
+        now = timeModule.time()
+        row = connection.execute('SELECT date, time, auditorium, status, seen FROM admission WHERE ticket = ?;', (ticket,)).fetchone()
+        if row is None:
+            return ('expired', 0, 0)
+        date, time, auditorium, status, seen = row
+        if status == 'waiting' and seen < now - self.waitTimeout:
+            status = 'expired'
+        if status != 'waiting':
+            return (status, 0, 0)
+        try:
+            active, ahead = self.queue(date, time, auditorium, ticket, now)
+            if ahead < self.sessionLimit - active:
+                with connection:
+                    connection.execute('BEGIN IMMEDIATE;') # one admission decision at a time across processes
+                    active, ahead = self.queue(date, time, auditorium, ticket, now)
+                    if ahead < self.sessionLimit - active:
+                        connection.execute('UPDATE admission SET status = \'admitted\', admitted = ? WHERE ticket = ?;', (now, ticket))
+                        logging.info('Ticket %d admitted to %s at %s in auditorium %s', ticket, date, time, auditorium)
+                        return ('admitted', 0, 0)
+            if seen < now - self.waitTimeout / 2:
+                with connection:
+                    connection.execute('UPDATE admission SET seen = ? WHERE ticket = ?;', (now, ticket))
+        except Error as e:
+            if getattr(e, 'sqlite_errorname', None) not in ('SQLITE_BUSY', 'SQLITE_LOCKED') and 'locked' not in str(e):
+                logging.info(e)
+                return ('admitted', 0, 0) # a broken queue must not lock customers out
+            logging.info('Ticket %d keeps waiting: %s', ticket, e) # but a busy one must not let everyone in
+        position = ahead + 1
+        return ('waiting', position, self.estimateWait(date, time, auditorium, position - (self.sessionLimit - active)))
+
+    def queue(self, date, time, auditorium, ticket, now):
+        """
+        The function counts the live sessions of a screening and the live tickets waiting ahead of a ticket.
+
+        Returns (active, ahead)
+        """
+        connection = self.getConnection()
+        s = ('SELECT count(*) FROM admission WHERE auditorium = ? AND date = ? AND time = ? AND status = \'admitted\' AND admitted >= ?;')
+        active = connection.execute(s, (auditorium, date, time, now - self.sessionTimeout)).fetchone()[0]
+        s = ('SELECT count(*) FROM admission WHERE auditorium = ? AND date = ? AND time = ? AND status = \'waiting\' AND ticket < ? AND seen >= ?;')
+        ahead = connection.execute(s, (auditorium, date, time, ticket, now - self.waitTimeout)).fetchone()[0]
+        return (active, ahead)
+
+    def estimateWait(self, date, time, auditorium, turns):
+        """
+        The function estimates the wait from the average length of the last sessions of the screening.
+
+        Parameters:
+            turns (int): how many sessions have to end before the ticket is admitted
+        """
+        s = ('SELECT avg(finished - admitted) FROM (SELECT finished, admitted FROM admission '
+             'WHERE auditorium = ? AND date = ? AND time = ? AND status = \'done\' ORDER BY ticket DESC LIMIT 20);')
+        duration = self.getConnection().execute(s, (auditorium, date, time)).fetchone()[0] or self.defaultDuration
+        rounds = -(-max(turns, 1) // self.sessionLimit) # ceiling division
+        return int(rounds * duration)
+
+    def wait(self, ticket):
+        """
+        The function waits until the ticket is admitted, showing the queue position.
+
+        Returns True when admitted; False if the ticket expired.
+        """
+        shown = None
+        while True:
+            status, position, estimate = self.poll(ticket)
+            if status == 'admitted':
+                return True
+            if status != 'waiting':
+                print('Your place in the queue has expired. Please try again.')
+                return False
+            if position != shown:
+                print('The screening is busy. You are number {} in the queue (about {} seconds).'.format(position, estimate))
+                shown = position
+            timeModule.sleep(self.pollInterval)
+
+    def release(self, ticket):
+        """
+        The function ends a booking session and lets the next ticket in.
+        """
+        s = 'UPDATE admission SET status = CASE status WHEN \'admitted\' THEN \'done\' ELSE \'expired\' END, finished = ? WHERE ticket = ?;'
+        with self.getConnection() as connection:
+            connection.execute(s, (timeModule.time(), ticket))
+        logging.info(s)
+
+    def purge(self):
+        """
+        The function deletes the tickets that can no longer be admitted, without committing: the expired ones,
+        those that stopped polling or overran their session, and the finished ones older than 'history'.
+
+        Returns the number of tickets deleted
+        """
+        now = timeModule.time()
+        s = ('DELETE FROM admission WHERE status = \'expired\' OR (status = \'waiting\' AND seen < ?) '
+             'OR (status = \'admitted\' AND admitted < ?) OR (status = \'done\' AND finished < ?);')
+        deleted = self.getConnection().execute(s, (now - self.waitTimeout, now - self.sessionTimeout, now - self.history)).rowcount
+        logging.info(s)
+        return deleted
+
+class SiteRouter:
+    """
+    Maps each cinema site to its own database file, so the sites do not share one sqlite writer lock.
+    A site's connection is opened, and its schema migrated, the first time the site is used.
+    Chain-wide reports query every site in parallel, each on its own connection, and merge the rows.
+    Bookings are routed per process: a session books on the site it was started for (--site).
+    """
+    def __init__(self, sites, metrics = None, profiler = None):
+        self._sites = sites # site -> Database
+        self._cursors = {}
+        self._metrics = metrics
+        self._profiler = profiler
+
+    @classmethod
+    def fromFile(cls, filename, metrics = None, profiler = None):
+        """
+        The function reads the sites from a JSON file mapping each site to its database file,
+        e.g. {"soho": "soho.db", "camden": "camden.db"}.
+        """
+        with open(filename) as file:
+            config = json.load(file)
+        return cls({site: Database(databaseFile) for site, databaseFile in config.items()}, metrics, profiler)
+
+    def getSites(self):
+        return sorted(self._sites)
+
+    def getDatabase(self, site):
+        return self._sites[site]
+
+    def getCursor(self, site):
+        """
+        The function returns the connection of the site that owns the data, opening it on first use.
+        """
+        cursor = self._cursors.get(site)
+        if cursor is None:
+            database = self._sites[site]
+            cursor = Cursor(database)
+            if self._metrics:
+                cursor.getConnection().set_trace_callback(self._metrics.countQuery)
+            if self._profiler:
+                cursor.setProfiler(self._profiler)
+            logging.info('Connects to the database %s of site %s.', database.getFilename(), site)
+            cursor.migrate() # a single PRAGMA once the schema is up to date
+            self._cursors[site] = cursor
+        return cursor
+
+    def chainReport(self):
+        """
+        The function runs the schedule report on every site in parallel.
+
+        Returns a list of (site, filmID, film, date, time, auditorium, available, booked, zone prices...) ordered by date, time, site and auditorium
+        """
+        for site in self.getSites():
+            self.getCursor(site) # opens, and so migrates, each site once, before the read-only reports
+        def report(site):
+            cursor = Cursor(self._sites[site]) # sqlite connections cannot be shared between threads
+            if self._profiler:
+                cursor.setProfiler(self._profiler)
+            try:
+                return [(site,) + row for row in cursor.scheduleReport()]
+            finally:
+                cursor.getConnection().close()
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers = len(self._sites)) as pool:
+            results = list(pool.map(report, self.getSites()))
+        return sorted((row for rows in results for row in rows), key = lambda row: (row[3], row[4], row[0], row[5]))
+
+    def exportChain(self, filename = None):
+        """
+        The function writes the schedule report of the whole chain to a CSV file.
+
+        Parameters:
+            filename (string): the file to write, 'YYYYMMDD_HHMM_chainFilmsAndSeats.csv' if None
+        Returns the filename
+        """
+        result = self.chainReport()
+        if filename is None:
+            outputTime = datetime.datetime.now().strftime('%Y%m%d_%H%M')
+            filename = '{}_chainFilmsAndSeats.csv'.format(outputTime)
+        file = open(filename, 'w+')
+        file.write('site, filmID, film, date, time, auditorium, available_seats, booked_seats, ' + ', '.join(zone + '_price' for zone, letters, base in Database.priceZone) + '\n')
+        for row in result:
+            file.write(', '.join(str(i) for i in row) + '\n')
+        file.close()
+        return filename
+
+    def close(self):
+        for cursor in self._cursors.values():
+            cursor.getConnection().close()
+        self._cursors = {}
+
+class Batch:
+    """
+    Runs structured operations from a JSON Lines stream without prompting, one JSON result per line.
+    Each line is an object with an 'op' and its fields, e.g.
+        {"op": "book", "username": "alice", "filmID": "1", "date": "2019/01/08", "time": "11:00", "seats": "B3 B4", "key": "c1f0..."}
+        {"op": "cancel", "username": "alice", "date": "2019/01/08", "time": "11:00", "seats": "B3 B4"}
+        {"op": "addAuditorium", "auditorium": "2", "name": "Screen 2"}
+        {"op": "addScreening", "filmID": "1", "date": "2019/01/08", "time": "11:00", "auditorium": "2", "duration": 95}
+        {"op": "checkout", "username": "alice", "cart": [{"filmID": "1", "date": "2019/01/08", "time": "11:00", "seats": "B3 B4"}, ...], "key": "9a2e..."}
+        {"op": "reprice"}
+        {"op": "export", "file": "schedule.csv"}
+        {"op": "export", "delta": true, "consumer": "reporting", "format": "jsonl"}
+    The screening operations take an optional 'auditorium', Database.defaultAuditorium if it is left out.
+    Operations are committed in groups of 'groupSize'; a failed operation only rolls back itself.
+    A 'book', 'cancel' or 'checkout' with a 'key' that already succeeded returns its first result instead of running again;
+    the keys are shared with the menus (see Cursor.lookupRequest), and reusing one for another request is an error.
+    """
+    def __init__(self, Cursor, groupSize = 500):
+        self._cml = CommandLine(Cursor)
+        self._groupSize = groupSize
+        self._operations = {'book': self.book, 'cancel': self.cancel, 'addScreening': self.addScreening, 'addAuditorium': self.addAuditorium,
+                            'checkout': self.checkout, 'reprice': self.reprice, 'export': self.export}
+
+    def getCursor(self):
+        return self._cml.getCursor()
+
+    def run(self, stream, out = sys.stdout):
+        """
+        The function runs every operation of 'stream' and writes the results to 'out'.
+
+        Parameters:
+            stream (file): the JSON Lines operations
+            out (file): where the JSON results are written
+        Returns (succeeded, failed)
+        """
+        connection = self.getCursor().getConnection()
+        c = self.getCursor().getCursor()
+        succeeded = 0
+        failed = 0
+        inGroup = 0
+        connection.commit()
+        c.execute('BEGIN;')
+        for lineNumber, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            c.execute('SAVEPOINT operation;')
+            mark = self.getCursor().getFeed().mark()
+            try:
+                operation = json.loads(line)
+                if not isinstance(operation, dict):
+                    result = {'ok': False, 'error': 'not an object'}
+                elif operation.get('op') in self._operations:
+                    result = self._operations[operation['op']](operation)
+                else:
+                    result = {'ok': False, 'error': 'unknown operation'}
+            except Exception as e: # e.g. a missing field or one of the wrong type; only this operation is rolled back
+                logging.info('Batch line %d failed: %r', lineNumber, e)
+                result = {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+            if result['ok']:
+                c.execute('RELEASE operation;')
+                succeeded += 1
+            else:
+                c.execute('ROLLBACK TO operation;')
+                c.execute('RELEASE operation;')
+                self.getCursor().getFeed().discard(mark)
+                failed += 1
+            result['line'] = lineNumber
+            out.write(json.dumps(result) + '\n')
+            inGroup += 1
+            if inGroup == self._groupSize:
+                connection.commit()
+                self.getCursor().getFeed().flush()
+                c.execute('BEGIN;')
+                inGroup = 0
+        connection.commit()
+        self.getCursor().getFeed().flush()
+        logging.info('Batch finished: %d succeeded, %d failed', succeeded, failed)
+        return (succeeded, failed)
+
+    def replay(self, operation, parameters):
+        """
+        The function looks up an operation retried with the same 'key' (see Cursor.lookupRequest).
+
+        Returns None if it is new, the stored result of its first run,
+        or Error if the key was used for another operation or with other parameters.
+        """
+        return self.getCursor().lookupRequest(operation.get('key'), operation['op'], parameters)
+
+    def book(self, operation):
+        """
+        The function books the seats of a screening (fields: username, filmID, date, time, seats; optional: auditorium, key).
+        """
+        seats = operation['seats'].split()
+        auditorium = operation.get('auditorium', Database.defaultAuditorium)
+        parameters = [operation['username'], str(operation['filmID']), operation['date'], operation['time'], auditorium, seats]
+        stored = self.replay(operation, parameters)
+        if stored is Error:
+            return {'ok': False, 'op': 'book', 'error': 'key already used for another request'}
+        if stored is not None:
+            return {'ok': True, 'op': 'book', 'seats': ' '.join(seats), 'replayed': True}
+        if not seats or not all(CommandLine.checkSeatInput(i) for i in seats):
+            return {'ok': False, 'op': 'book', 'error': 'invalid seats'}
+        occupied = self.getCursor().bookSeats(operation['username'], operation['filmID'], operation['date'], operation['time'], auditorium, seats)
+        if occupied is Error:
+            return {'ok': False, 'op': 'book', 'error': 'no such screening'}
+        if occupied:
+            return {'ok': False, 'op': 'book', 'error': 'seats taken', 'occupied': occupied}
+        self.getCursor().recordRequest(operation.get('key'), 'book', parameters, occupied)
+        return {'ok': True, 'op': 'book', 'seats': ' '.join(seats)}
+
+    def checkout(self, operation):
+        """
+        The function books the seats of several screenings, all or nothing (fields: username, cart; optional: key).
+        """
+        cart = [(item['filmID'], item['date'], item['time'], item.get('auditorium', Database.defaultAuditorium), item['seats'].split()) for item in operation['cart']]
+        parameters = [operation['username'], [[str(filmID), date, time, auditorium, seats] for filmID, date, time, auditorium, seats in cart]]
+        stored = self.replay(operation, parameters)
+        if stored is Error:
+            return {'ok': False, 'op': 'checkout', 'error': 'key already used for another request'}
+        if stored is not None:
+            return {'ok': True, 'op': 'checkout', 'screenings': len(cart), 'replayed': True}
+        if not cart or not all(item[4] and all(CommandLine.checkSeatInput(i) for i in item[4]) for item in cart):
+            return {'ok': False, 'op': 'checkout', 'error': 'invalid seats'}
+        conflicts = self.getCursor().bookCart(operation['username'], cart)
+        if conflicts:
+            return {'ok': False, 'op': 'checkout', 'error': 'conflicts',
+                    'conflicts': [{'filmID': i[0], 'date': i[1], 'time': i[2], 'auditorium': i[3], 'occupied': i[4]} for i in conflicts]}
+        self.getCursor().recordRequest(operation.get('key'), 'checkout', parameters, conflicts)
+        return {'ok': True, 'op': 'checkout', 'screenings': len(cart)}
+
+    def cancel(self, operation):
+        """
+        The function cancels a booking and promotes the waitlist (fields: username, date, time, seats; optional: auditorium, key).
+        """
+        auditorium = operation.get('auditorium', Database.defaultAuditorium)
+        parameters = [operation['username'], operation['date'], operation['time'], auditorium, operation['seats']]
+        promoted = self.replay(operation, parameters)
+        if promoted is Error:
+            return {'ok': False, 'op': 'cancel', 'error': 'key already used for another request'}
+        replayed = promoted is not None
+        if not replayed:
+            promoted = self.getCursor().deleteBooking(operation['username'], operation['date'], operation['time'], auditorium, operation['seats'])
+            if promoted is Error:
+                return {'ok': False, 'op': 'cancel', 'error': 'no such future booking'}
+            self.getCursor().recordRequest(operation.get('key'), 'cancel', parameters, promoted)
+        result = {'ok': True, 'op': 'cancel', 'promoted': [{'username': i[0], 'seats': i[2]} for i in promoted]}
+        if replayed:
+            result['replayed'] = True
+        return result
+
+    def addScreening(self, operation):
+        """
+        The function adds a screening time with empty seats (fields: filmID, date, time; optional: auditorium,
+        duration in minutes, default Database.defaultDuration). It fails if the screening overlaps another one in the auditorium.
+        """
+        try:
+            self.getCursor().addScreening(operation['filmID'], operation['date'], operation['time'],
+                                          operation.get('auditorium', Database.defaultAuditorium), operation.get('duration', Database.defaultDuration))
+        except sqlite3.IntegrityError as e:
+            return {'ok': False, 'op': 'addScreening', 'error': str(e)}
+        return {'ok': True, 'op': 'addScreening'}
+
+    def addAuditorium(self, operation):
+        """
+        The function adds an auditorium (fields: auditorium, name).
+        """
+        try:
+            self.getCursor().addAuditorium(operation['auditorium'], operation['name'])
+        except sqlite3.IntegrityError:
+            return {'ok': False, 'op': 'addAuditorium', 'error': 'auditorium exists'}
+        return {'ok': True, 'op': 'addAuditorium'}
+
+    def reprice(self, operation):
+        """
+        The function recomputes the price table of the screenings whose occupancy crossed a threshold.
+        """
+        return {'ok': True, 'op': 'reprice', 'repriced': self.getCursor().repriceScreenings()}
+
+    def export(self, operation):
+        """
+        The function exports the schedule (optional fields: file, format 'csv' or 'jsonl',
+        delta to write only the screenings changed since the last delta export of consumer, default 'reporting').
+        """
+        fileFormat = operation.get('format', 'csv')
+        if fileFormat not in ('csv', 'jsonl'):
+            return {'ok': False, 'op': 'export', 'error': 'unknown format'}
+        consumer = operation.get('consumer', 'reporting') if operation.get('delta') else None
+        filename = self._cml.exportSchedule(operation.get('file'), consumer, fileFormat)
+        return {'ok': True, 'op': 'export', 'file': filename}
+
+def processStart():
+    """
+    The function returns the time the process started, on the perf_counter clock, so that the cold-start report
+    includes the interpreter start-up and the imports. It is read from /proc on Linux (to 10 ms),
+    and is 'startTime', taken on the first line of this module, elsewhere.
+    """
+    try:
+        with open('/proc/self/stat') as stat, open('/proc/uptime') as uptime:
+            ticks = int(stat.read().rsplit(')', 1)[1].split()[19]) # the 22nd field, starttime, after the command name
+            age = float(uptime.read().split()[0]) - ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return startTime
+    return min(startTime, timeModule.perf_counter() - age)
+
 def main():
+    import argparse
+    parser = argparse.ArgumentParser(description = 'The cinema booking system.')
+    parser.add_argument('--batch', metavar = 'FILE', help = 'run the JSON Lines operations in FILE (\'-\' for stdin) instead of the menus')
+    parser.add_argument('--feed-port', type = int, help = 'stream seat changes to local clients on this TCP port')
+    parser.add_argument('--archive', metavar = 'DATE', nargs = '?', const = datetime.date.today().strftime('%Y/%m/%d'),
+                        help = 'move the screenings before DATE (default: today) to the archive and exit')
+    parser.add_argument('--reprice', action = 'store_true', help = 'recompute the occupancy-based prices of every screening and exit')
+    parser.add_argument('--session-limit', type = int, default = AdmissionController.sessionLimit,
+                        help = 'booking sessions admitted per screening at the same time (default: %(default)s)')
+    parser.add_argument('--metrics-file', metavar = 'FILE', help = 'write Prometheus metrics to FILE periodically and on exit')
+    parser.add_argument('--metrics-interval', type = int, default = 15, help = 'seconds between metrics writes (default: 15)')
+    parser.add_argument('--slow-query-ms', type = float, default = 50, help = 'log statements slower than this with their query plan (default: %(default)s)')
+    parser.add_argument('--startup-time', action = 'store_true', help = 'print the cold-start time')
+    parser.add_argument('--sites', metavar = 'FILE', help = 'JSON file mapping each cinema site to its database file')
+    parser.add_argument('--site', help = 'the site this session works on (default: the first site)')
+    parser.add_argument('--benchmark-seatmaps', metavar = 'N', type = int, help = 'compare the memory of N cached seat maps and exit')
+    parser.add_argument('--group', type = int, default = 500, help = 'operations per transaction in batch mode (default: 500)')
+    args = parser.parse_args()
     logging.basicConfig(filename = 'cinema.log', filemode = 'w', format = '%(asctime)s %(levelname)s %(message)s'
                         , level = logging.INFO)
-    databaseFile = 'bookingSystem.db'
-    bookingSystem = Database(databaseFile)
-    cursor = Cursor(bookingSystem) # connect and create cursor
-    logging.info('Connects to the database %s.', databaseFile)
-    command = CommandLine(cursor)
+    metrics = None
+    if args.metrics_file or not (args.batch or args.archive or args.reprice or args.benchmark_seatmaps): # the menus show metrics to admins
+        metrics = Metrics()
+        metrics.instrument()
+    if args.metrics_file:
+        metrics.startExport(args.metrics_file, args.metrics_interval)
+    profiler = QueryProfiler(args.slow_query_ms / 1000)
+    if args.sites:
+        router = SiteRouter.fromFile(args.sites, metrics, profiler)
+    else:
+        router = SiteRouter({'main': Database('bookingSystem.db', 'bookingArchive.db', 'bookingQueue.db')}, metrics, profiler)
+    site = args.site or router.getSites()[0]
+    if site not in router.getSites():
+        print('Unknown site {}; the sites are {}.'.format(site, ', '.join(router.getSites())), file = sys.stderr)
+        return
+    databaseFile = router.getDatabase(site).getFilename()
+    cursor = router.getCursor(site) # connect, create cursor and migrate
+    version = cursor.getVersion()
+    startup = timeModule.perf_counter() - processStart()
+    if metrics:
+        metrics.observe('startup', startup, metrics.getQueryCount())
+    logging.info('Started in %.1f ms with schema version %d.', 1000 * startup, version)
+    if args.startup_time:
+        print('Started in {:.1f} ms (schema version {}).'.format(1000 * startup, version), file = sys.stderr)
+    if args.archive:
+        cursor.purgeRequests() # maintenance of the hot tables runs here, off the startup path
+        archived = cursor.archiveScreenings(args.archive)
+        if archived is Error:
+            print('Archiving failed; see cinema.log.', file = sys.stderr)
+        else:
+            print('{} screening(s) before {} archived.'.format(archived, args.archive))
+        router.close()
+        return
+    if args.reprice:
+        start = timeModule.perf_counter()
+        try:
+            with cursor.getConnection():
+                repriced = cursor.repriceScreenings()
+        except Error as e:
+            logging.info(e)
+            print('Repricing failed; see cinema.log.', file = sys.stderr)
+        else:
+            print('{} screening(s) repriced in {:.1f} ms.'.format(repriced, 1000 * (timeModule.perf_counter() - start)))
+        router.close()
+        return
+    if args.benchmark_seatmaps:
+        tuples, seatMaps = seatMapBenchmark(args.benchmark_seatmaps)
+        print('{} screenings x 400 seats: tuples of strings {:.1f} KiB, SeatMap {:.1f} KiB ({:.1f}x smaller).'.format(
+              args.benchmark_seatmaps, tuples / 1024, seatMaps / 1024, tuples / seatMaps))
+        router.close()
+        return
+    if args.feed_port:
+        SeatFeedServer(cursor.getFeed(), databaseFile, args.feed_port)
+    if args.batch:
+        stream = sys.stdin if args.batch == '-' else open(args.batch)
+        succeeded, failed = Batch(cursor, args.group).run(stream)
+        print('{} succeeded, {} failed'.format(succeeded, failed), file = sys.stderr)
+        profiler.logSummary()
+        router.close()
+        if args.metrics_file:
+            metrics.writePrometheus(args.metrics_file)
+        return
+    command = CommandLine(cursor, AdmissionController(cursor, args.session_limit), metrics, router)
     print('-----------------------------------')
     print('       Welcome to THE CINEMA')
     print('-----------------------------------\n')
@@ -1073,7 +3612,11 @@ def main():
     print('\n-----------------------------------')
     print('    Bye Bye. See you next time!')
     print('-----------------------------------')
-    command.getCursor().getConnection().close()
+    profiler.logSummary()
+    command.getAdmission().close()
+    router.close()
+    if args.metrics_file:
+        metrics.writePrometheus(args.metrics_file)
 
 if __name__ == '__main__': main()
     
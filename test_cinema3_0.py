@@ -0,0 +1,432 @@
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import time
+from sqlite3 import Error
+
+import pytest
+
+from cinema3_0 import AdmissionController, availabilityExpression, Batch, Cursor, Database, Metrics, QueryProfiler, SeatFeedServer, SeatMap, SiteRouter
+
+baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bookingSystem.db')
+
+@pytest.fixture
+def cursor(tmp_path):
+    """
+    A Cursor on a migrated copy of the baseline database, with an empty auditorium '2'.
+    """
+    filename = str(tmp_path / 'bookingSystem.db')
+    shutil.copy(baseline, filename)
+    cursor = Cursor(Database(filename))
+    cursor.migrate()
+    with cursor.getConnection():
+        cursor.addAuditorium('2', 'Screen 2')
+    yield cursor
+    cursor.getConnection().close()
+
+def schedule(cursor, date, time, duration, auditorium = '2'):
+    with cursor.getConnection():
+        cursor.addScreening('1', date, time, auditorium, duration)
+
+def test_migrate_baseline(tmp_path):
+    filename = str(tmp_path / 'bookingSystem.db')
+    shutil.copy(baseline, filename)
+    before = sqlite3.connect(filename)
+    counts = {table: before.execute('SELECT count(*) FROM ' + table).fetchone()[0] for table in ('filmTime', 'seats', 'booking')}
+    before.close()
+    cursor = Cursor(Database(filename))
+    latest = Database.migrations[-1][0]
+    assert cursor.migrate() == latest >= 11
+    c = cursor.getCursor()
+    assert c.execute('PRAGMA user_version;').fetchone()[0] == latest
+    for table, count in counts.items():
+        assert c.execute('SELECT count(*) FROM ' + table).fetchone()[0] == count
+    assert c.execute('SELECT DISTINCT auditorium, duration FROM filmTime;').fetchall() == [('1', 60)]
+    assert c.execute('SELECT count(*) FROM filmTime WHERE finish IS NULL;').fetchone()[0] == 0
+    assert c.execute('SELECT count(*) FROM availability;').fetchone()[0] == counts['seats']
+    assert cursor.migrate() == latest # nothing left to apply
+    cursor.getConnection().close()
+
+def test_migrate_fresh_database(tmp_path):
+    cursor = Cursor(Database(str(tmp_path / 'new.db')))
+    assert cursor.migrate() == Database.migrations[-1][0]
+    assert cursor.getCursor().execute('SELECT auditoriumID FROM auditorium;').fetchall() == [('1',)]
+    cursor.getConnection().close()
+
+def test_overlap_back_to_back(cursor):
+    schedule(cursor, '2019/02/01', '20:00', 120)
+    assert cursor.findOverlap('2', '2019/02/01', '22:00', 60) is None
+    assert cursor.findOverlap('2', '2019/02/01', '18:00', 120) is None
+    assert cursor.findOverlap('2', '2019/02/01', '21:59', 60) == ('1', '2019/02/01', '20:00', '2019/02/01 22:00')
+    assert cursor.findOverlap('2', '2019/02/01', '18:00', 121) is not None
+    assert cursor.findOverlap('2', '2019/02/01', '20:00', 10) is not None
+    assert cursor.findOverlap('1', '2019/02/01', '20:00', 120) is None # another auditorium
+    schedule(cursor, '2019/02/01', '22:00', 60)
+    schedule(cursor, '2019/02/01', '18:00', 120)
+
+def test_overlap_across_midnight(cursor):
+    schedule(cursor, '2019/02/01', '23:30', 90) # finishes at 01:00 the next day
+    assert cursor.findOverlap('2', '2019/02/02', '00:30', 30) == ('1', '2019/02/01', '23:30', '2019/02/02 01:00')
+    assert cursor.findOverlap('2', '2019/02/02', '01:00', 30) is None
+    schedule(cursor, '2019/02/03', '00:30', 60)
+    assert cursor.findOverlap('2', '2019/02/02', '23:45', 60) == ('1', '2019/02/03', '00:30', '2019/02/03 01:30')
+    assert cursor.findOverlap('2', '2019/02/02', '23:30', 60) is None
+
+def test_overlap_rejects_bad_duration(cursor):
+    for duration in (0, -30, -600):
+        with pytest.raises(ValueError):
+            cursor.findOverlap('2', '2019/02/01', '09:00', duration)
+        with pytest.raises(sqlite3.IntegrityError):
+            cursor.addScreening('1', '2019/02/01', '09:00', '2', duration)
+    assert cursor.getCursor().execute('SELECT count(*) FROM filmTime WHERE auditorium = \'2\';').fetchone()[0] == 0
+
+def test_add_screening_errors(cursor):
+    schedule(cursor, '2019/02/01', '20:00', 120)
+    with pytest.raises(sqlite3.IntegrityError, match = 'time slot occupied'):
+        schedule(cursor, '2019/02/01', '21:00', 30)
+    with pytest.raises(sqlite3.IntegrityError, match = 'no such auditorium'):
+        schedule(cursor, '2019/02/01', '21:00', 30, '9')
+    schedule(cursor, '2019/02/01', '20:00', 120, '1') # the same time in another auditorium
+
+def run(cursor, *operations):
+    out = io.StringIO()
+    Batch(cursor).run(io.StringIO('\n'.join(json.dumps(i) for i in operations)), out)
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+def test_batch_screenings_and_cart(cursor):
+    results = run(cursor,
+                  {'op': 'addScreening', 'filmID': '1', 'date': '2019/02/01', 'time': '09:00', 'auditorium': '2', 'duration': -600},
+                  {'op': 'addScreening', 'filmID': '1', 'date': '2019/02/01', 'time': '09:00', 'auditorium': '2', 'duration': 90},
+                  {'op': 'addScreening', 'filmID': '2', 'date': '2019/02/01', 'time': '10:00', 'auditorium': '2'},
+                  {'op': 'addScreening', 'filmID': '2', 'date': '2019/02/01', 'time': '10:30', 'auditorium': '2'},
+                  {'op': 'checkout', 'username': 'u', 'cart': [{'filmID': '1', 'date': '2019/02/01', 'time': '09:00', 'auditorium': '2', 'seats': 'A1 A2'},
+                                                               {'filmID': '2', 'date': '2019/02/01', 'time': '10:30', 'auditorium': '2', 'seats': 'B1'}]},
+                  {'op': 'checkout', 'username': 'v', 'cart': [{'filmID': '2', 'date': '2019/02/01', 'time': '10:30', 'auditorium': '2', 'seats': 'C1'},
+                                                               {'filmID': '1', 'date': '2019/02/01', 'time': '09:00', 'auditorium': '2', 'seats': 'A2 A3'}]})
+    assert [i['ok'] for i in results] == [False, True, False, True, True, False]
+    assert results[0]['error'] == 'duration must be positive'
+    assert results[2]['error'] == 'time slot occupied'
+    assert results[5]['conflicts'][0]['occupied'] == ['A2']
+    c = cursor.getCursor()
+    assert c.execute('SELECT username, seat FROM booking WHERE auditorium = \'2\' ORDER BY seat;').fetchall() == [('u', 'A1 A2'), ('u', 'B1')]
+
+def test_batch_rejects_lines_that_are_not_objects(cursor):
+    out = io.StringIO()
+    assert Batch(cursor).run(io.StringIO('[1]\n5\n"x"\n{"op": "reprice"}\n'), out) == (1, 3)
+    assert [json.loads(line).get('error') for line in out.getvalue().splitlines()] == ['not an object'] * 3 + [None]
+
+def test_batch_cancel_only_future_bookings(cursor):
+    past = cursor.getCursor().execute('SELECT username, date, time, seat FROM booking LIMIT 1;').fetchone()
+    results = run(cursor,
+                  {'op': 'cancel', 'username': past[0], 'date': past[1], 'time': past[2], 'seats': past[3]},
+                  {'op': 'addScreening', 'filmID': '1', 'date': '2099/01/01', 'time': '11:00', 'auditorium': '2'},
+                  {'op': 'book', 'username': 'u', 'filmID': '1', 'date': '2099/01/01', 'time': '11:00', 'auditorium': '2', 'seats': 'A1'},
+                  {'op': 'cancel', 'username': 'u', 'date': '2099/01/01', 'time': '11:00', 'auditorium': '2', 'seats': 'A1'})
+    assert [i['ok'] for i in results] == [False, True, True, True]
+    assert results[0]['error'] == 'no such future booking'
+    assert cursor.getCursor().execute('SELECT count(*) FROM booking WHERE username = ? AND date = ?;', past[:2]).fetchone()[0] >= 1
+
+def test_idempotency_keys_bound_to_parameters(cursor):
+    schedule(cursor, '2099/01/01', '11:00', 120)
+    assert cursor.makeBooking('u', '1', '2099/01/01', '11:00', '2', ['A1'], 'k1') == []
+    book = {'op': 'book', 'username': 'u', 'filmID': '1', 'date': '2099/01/01', 'time': '11:00', 'auditorium': '2', 'seats': 'A1', 'key': 'k1'}
+    results = run(cursor, book, dict(book, seats = 'A2'), dict(book, op = 'cancel'), dict(book, key = 'k2', seats = 'B1'), dict(book, key = 'k2', seats = 'B1'))
+    assert [i['ok'] for i in results] == [True, False, False, True, True]
+    assert results[0]['replayed'] and results[4]['replayed'] and 'replayed' not in results[3]
+    assert results[1]['error'] == results[2]['error'] == 'key already used for another request'
+    assert cursor.makeBooking('u', '1', '2099/01/01', '11:00', '2', ['C1'], 'k2') is Error
+    assert cursor.getCursor().execute('SELECT seat FROM booking WHERE auditorium = \'2\' ORDER BY seat;').fetchall() == [('A1',), ('B1',)]
+
+def test_admission_purge(cursor):
+    admission = AdmissionController(cursor, 1)
+    first, second, third = (admission.enter(username, '2099/01/01', '11:00', '2') for username in 'uvw')
+    assert admission.poll(first)[0] == 'admitted'
+    assert admission.poll(second)[0] == 'waiting'
+    admission.release(first)
+    with admission.getConnection() as connection:
+        connection.execute('UPDATE admission SET seen = ? WHERE ticket = ?;', (time.time() - 60, third)) # stopped polling
+        connection.execute('INSERT INTO admission (username, date, time, auditorium, status, admitted, finished) VALUES (\'x\', \'2099/01/01\', \'11:00\', \'2\', \'done\', 0, 1);')
+    with admission.getConnection() as connection:
+        assert admission.purge() == 2
+    assert connection.execute('SELECT ticket, status FROM admission ORDER BY ticket;').fetchall() == [(first, 'done'), (second, 'waiting')]
+    plan = connection.execute('EXPLAIN QUERY PLAN SELECT count(*) FROM admission WHERE auditorium = ? AND date = ? AND time = ? AND status = \'waiting\' AND ticket < ?;', ('2', '2099/01/01', '11:00', 5)).fetchall()
+    assert 'admissionQueue' in plan[0][-1]
+    admission.close()
+
+def test_admission_polls_without_writing(cursor):
+    admission = AdmissionController(cursor, 1)
+    first, second = (admission.enter(username, '2099/01/01', '11:00', '2') for username in 'uv')
+    assert admission.poll(first)[0] == 'admitted'
+    changes = admission.getConnection().total_changes
+    assert admission.poll(second)[:2] == ('waiting', 1)
+    assert admission.getConnection().total_changes == changes # a fresh waiting ticket only reads
+    assert cursor.getCursor().execute('SELECT count(*) FROM sqlite_master WHERE name = \'admission\';').fetchone()[0] == 0
+    locker = sqlite3.connect(cursor.getDatabase().getQueueFilename())
+    admission.release(first)
+    locker.execute('BEGIN IMMEDIATE;') # a surge holds the queue: the ticket keeps waiting instead of being let in
+    assert admission.poll(second)[0] == 'waiting'
+    locker.rollback()
+    assert admission.poll(second)[0] == 'admitted'
+    locker.close()
+    admission.close()
+
+def waitlist(cursor, date, status):
+    cursor.getCursor().execute('INSERT INTO waitlist (timeMark, username, filmID, date, time, auditorium, seatNum, status, seat) VALUES (\'\', ?, \'1\', ?, \'11:00\', \'2\', 1, ?, \'A1\');',
+                               (status, date, status))
+
+def test_waitlist_of_archived_and_cancelled_screenings(cursor, tmp_path):
+    for date in ('2019/02/01', '2099/01/01'):
+        schedule(cursor, date, '11:00', 120)
+        for status in ('waiting', 'booked', 'notified'):
+            waitlist(cursor, date, status)
+    cursor.getConnection().commit()
+    cursor.attachArchive(str(tmp_path / 'archive.db'))
+    assert cursor.archiveScreenings('2019/03/01') >= 1
+    assert cursor.cancelScreenings([('2099/01/01', '11:00', '2')]) == []
+    c = cursor.getCursor()
+    assert c.execute('SELECT date, username, status FROM waitlist WHERE auditorium = \'2\' ORDER BY date, waitID;').fetchall() == [
+        ('2019/02/01', 'booked', 'booked'), ('2099/01/01', 'booked', 'cancelled'), ('2099/01/01', 'notified', 'notified')]
+
+def test_seat_prices(cursor):
+    schedule(cursor, '2099/01/01', '11:00', 120)
+    assert cursor.makeBooking('u', '1', '2099/01/01', '11:00', '2', ['A1', 'E5']) == []
+    seats, prices = cursor.seatPrices(1, '2099/01/01', '11:00', '2')
+    assert len(seats) == len(Database.seatColumn) and [seats[0], seats[1], seats[-1]] == ['X', 'O', 'X']
+    assert prices == tuple(base for zone, letters, base in Database.priceZone) # not repriced yet
+    assert cursor.seatPrices('1', '2099/01/01', '11:00\' OR \'1', '2') is Error
+
+def test_batch_fields_of_the_wrong_type(cursor):
+    results = run(cursor,
+                  {'op': 'addScreening', 'filmID': '1', 'date': '2099/01/01', 'time': '11:00', 'auditorium': '2'},
+                  {'op': 'book', 'username': 'u', 'filmID': '1', 'date': '2099/01/01', 'time': '11:00', 'auditorium': '2', 'seats': 5},
+                  {'op': 'checkout', 'username': 'u', 'cart': [{'filmID': '1', 'date': '2099/01/01', 'time': '11:00', 'auditorium': '2', 'seats': ['A1']}]},
+                  {'op': 'book', 'username': 'u', 'filmID': '1', 'date': '2099/01/01', 'time': '11:00', 'auditorium': '2', 'seats': 'A2'})
+    assert [i['ok'] for i in results] == [True, False, False, True]
+    assert results[1]['error'].startswith('AttributeError')
+    cursor.getConnection().rollback() # nothing may be left uncommitted by the run
+    c = cursor.getCursor()
+    assert c.execute('SELECT count(*) FROM filmTime WHERE auditorium = \'2\';').fetchone()[0] == 1
+    assert c.execute('SELECT seat FROM booking WHERE auditorium = \'2\';').fetchall() == [('A2',)]
+
+def test_add_screening_stores_padded_date_and_time(cursor):
+    schedule(cursor, '2099/1/1', '9:00', 60)
+    c = cursor.getCursor()
+    assert c.execute('SELECT date, time, finish FROM filmTime WHERE auditorium = \'2\';').fetchall() == [('2099/01/01', '09:00', '2099/01/01 10:00')]
+    assert c.execute('SELECT date, time FROM seats WHERE auditorium = \'2\';').fetchall() == [('2099/01/01', '09:00')]
+    assert cursor.findOverlap('2', '2099/01/01', '09:30', 60) == ('1', '2099/01/01', '09:00', '2099/01/01 10:00')
+    with pytest.raises(sqlite3.IntegrityError, match = 'time slot occupied'):
+        schedule(cursor, '2099/01/01', '9:30', 60)
+    with pytest.raises(ValueError):
+        schedule(cursor, '2099/13/01', '09:00', 60)
+
+def test_reschedule_cancelled_slot(cursor):
+    schedule(cursor, '2099/01/01', '11:00', 120)
+    schedule(cursor, '2099/01/01', '14:00', 120)
+    assert cursor.makeBooking('u', '1', '2099/01/01', '11:00', '2', ['A1']) == []
+    assert len(cursor.cancelScreenings([('2099/01/01', '11:00', '2')])) == 1
+    assert cursor.findOverlap('2', '2099/01/01', '12:00', 60) is None
+    assert cursor.scheduleScreening('2', '2099/01/01', '11:00', '2', 150) is None # the same slot, longer
+    assert cursor.scheduleScreening('1', '2099/01/01', '12:00', '2', 60) == 'time slot occupied'
+    c = cursor.getCursor()
+    assert c.execute('SELECT filmID, duration FROM filmTime WHERE auditorium = \'2\' AND time = \'11:00\';').fetchall() == [('2', 150)]
+    assert c.execute('SELECT count(*) FROM cancelled WHERE auditorium = \'2\';').fetchone()[0] == 0
+    assert cursor.seatPrices('2', '2099/01/01', '11:00', '2')[0][0] == 'O'
+
+def test_delta_export_sends_repriced_screenings(cursor, tmp_path):
+    schedule(cursor, '2099/01/01', '11:00', 120)
+    export = {'op': 'export', 'delta': True, 'consumer': 'reporting', 'format': 'jsonl', 'file': str(tmp_path / 'delta.jsonl')}
+    def exported():
+        with open(export['file']) as file:
+            return [json.loads(line) for line in file if '"2099/01/01"' in line]
+    seats = ' '.join(Database.seatColumn[:15])
+    assert [i['ok'] for i in run(cursor, export, {'op': 'book', 'username': 'u', 'filmID': '1', 'date': '2099/01/01', 'time': '11:00', 'auditorium': '2', 'seats': seats}, export)] == [True] * 3
+    assert [(i['booked_seats'], i['front_price']) for i in exported()] == [(15, 8.0)]
+    assert run(cursor, {'op': 'reprice'}, export)[0]['repriced'] >= 1
+    assert [(i['status'], i['front_price']) for i in exported()] == [('changed', 9.6)]
+    run(cursor, export)
+    assert exported() == []
+
+def test_seat_changes_logged_only_for_registered_consumers(cursor, tmp_path):
+    schedule(cursor, '2099/01/01', '11:00', 120)
+    c = cursor.getCursor()
+    count = lambda: c.execute('SELECT count(*) FROM seatChange;').fetchone()[0]
+    assert cursor.makeBooking('u', '1', '2099/01/01', '11:00', '2', ['A1']) == []
+    assert count() == 0
+    export = {'op': 'export', 'delta': True, 'consumer': 'reporting', 'format': 'jsonl', 'file': str(tmp_path / 'delta.jsonl')}
+    run(cursor, export)
+    assert cursor.makeBooking('u', '1', '2099/01/01', '11:00', '2', ['A2']) == []
+    assert count() == 1
+    run(cursor, export)
+    assert count() == 0 # pruned once every consumer exported it
+
+def test_seat_feed_slow_client_does_not_block_publishing(cursor):
+    schedule(cursor, '2099/01/01', '11:00', 120)
+    cursor.getConnection().commit()
+    server = SeatFeedServer(cursor.getFeed(), cursor.getDatabase().getFilename(), 0)
+    port = server._server.getsockname()[1]
+    stuck = socket.create_connection(('127.0.0.1', port)) # never reads
+    reader = socket.create_connection(('127.0.0.1', port))
+    lines = reader.makefile('r')
+    snapshot = json.loads(lines.readline())
+    assert set(snapshot) == {'filmID', 'date', 'time', 'auditorium', 'seatMap'}
+    start = time.perf_counter()
+    for i in range(2000): # far more than the socket buffers of the stuck client hold
+        cursor.getFeed().stage('1', '2099/01/01', '11:00', '2', ['A1'] * 50, 'X')
+        cursor.getFeed().flush()
+    assert time.perf_counter() - start < 1
+    event = json.loads(next(line for line in lines if '"seq"' in line))
+    assert event['seq'] == 1 and event['auditorium'] == '2'
+    server.close()
+    stuck.close()
+    reader.close()
+
+def test_chain_report_migrates_each_site_once(tmp_path):
+    sites = {}
+    for site in ('camden', 'soho'):
+        sites[site] = Database(str(tmp_path / (site + '.db')))
+        shutil.copy(baseline, sites[site].getFilename())
+    router = SiteRouter(sites)
+    rows = router.chainReport()
+    assert {row[0] for row in rows} == {'camden', 'soho'} and len(rows) == 2 * len(router.getCursor('soho').scheduleReport())
+    for site in sites:
+        assert router.getCursor(site).getVersion() == Database.migrations[-1][0]
+    router.close()
+
+def test_metrics_instrument_twice(cursor):
+    first, second = Metrics(), Metrics()
+    first.instrument()
+    second.instrument() # patches nothing again, records to 'second' from now on
+    schedule(cursor, '2099/01/01', '11:00', 120)
+    assert cursor.makeBooking('u', '1', '2099/01/01', '11:00', '2', ['A1']) == []
+    calls = {row[0]: row[1] for row in second.summary()}
+    assert calls['Cursor.makeBooking'] == 1 and calls['Cursor.addScreening'] == 1
+    assert first.summary() == []
+
+def test_waitlist_promotion_order_and_head_blocking(cursor):
+    schedule(cursor, '2099/01/01', '11:00', 120)
+    for seats in (['A1', 'A2'], ['A3'], ['B1', 'B2', 'B3']):
+        assert cursor.makeBooking('owner', '1', '2099/01/01', '11:00', '2', seats) == []
+    assert cursor.makeBooking('owner', '1', '2099/01/01', '11:00', '2', [i for i in Database.seatColumn if i not in ('A1', 'A2', 'A3', 'B1', 'B2', 'B3')]) == []
+    for username, seatNum in (('a', 3), ('b', 1), ('c', 2)):
+        cursor.insertWaitlist(('', username, '1', '2099/01/01', '11:00', '2', seatNum))
+    assert cursor.releaseBooking('owner', '2099/01/01', '11:00', '2', 'A1 A2') == [] # 'a' wants 3: nobody behind it jumps the queue
+    assert cursor.seatPrices('1', '2099/01/01', '11:00', '2')[0][:3] == ('O', 'O', 'X')
+    assert cursor.releaseBooking('owner', '2099/01/01', '11:00', '2', 'A3') == [('a', '1', 'A3 A1 A2')]
+    assert cursor.releaseBooking('owner', '2099/01/01', '11:00', '2', 'B1 B2 B3') == [('b', '1', 'B1'), ('c', '1', 'B2 B3')]
+    c = cursor.getCursor()
+    assert c.execute('SELECT username, status, seat FROM waitlist WHERE auditorium = \'2\' ORDER BY waitID;').fetchall() == [
+        ('a', 'booked', 'A3 A1 A2'), ('b', 'booked', 'B1'), ('c', 'booked', 'B2 B3')]
+    assert 'O' not in cursor.seatPrices('1', '2099/01/01', '11:00', '2')[0]
+
+def test_film_search_prefix_and_ranking(cursor):
+    cursor.insertFilm(('90', 'Starfall', 'A quiet drama.'))
+    cursor.insertFilm(('91', 'Quiet Nights', 'Two stars meet in the desert.'))
+    cursor.insertFilm(('92', 'Café Society', 'Jazz.'))
+    with cursor.getConnection():
+        cursor.addScreening('90', '2099/01/01', '11:00', '2', 60)
+        cursor.addScreening('90', '2099/01/02', '11:00', '2', 60)
+    cursor.cancelScreenings([('2099/01/01', '11:00', '2')])
+    assert [i[:2] for i in cursor.searchFilms('star')] == [('90', 'Starfall'), ('91', 'Quiet Nights')] # the title match ranks first
+    assert cursor.searchFilms('star')[0][2:] == ('2099/01/02', '11:00') # the next screening that is not cancelled
+    assert cursor.searchFilms('star')[1][2:] == (None, None)
+    assert [i[0] for i in cursor.searchFilms('qui nig')] == ['91'] # every keyword must match, each as a prefix
+    assert [i[0] for i in cursor.searchFilms('cafe')] == ['92']
+    assert cursor.searchFilms('"') == [] and cursor.searchFilms('   ') == []
+
+def test_seat_map_get_set_and_bytes():
+    generator = random.Random(7)
+    for size in [1, 7, 8, 9, 25, 400] + [generator.randint(1, 400) for i in range(300)]:
+        statuses = ''.join(generator.choice('OX') for i in range(size))
+        seatMap = SeatMap.fromString(statuses)
+        assert str(seatMap) == statuses and len(seatMap) == size
+        assert seatMap.taken() == statuses.count('X') and seatMap.available() == statuses.count('O')
+        i = generator.randrange(size)
+        seatMap.set(i, True)
+        seatMap.set(i, True) # setting a seat twice counts it once
+        assert seatMap.isTaken(i) and seatMap.taken() == statuses.count('X') + (statuses[i] == 'O')
+        seatMap.set(i, statuses[i] == 'X')
+        copy = SeatMap.fromBytes(seatMap.toBytes())
+        assert str(copy) == statuses and copy.taken() == seatMap.taken() and len(seatMap.toBytes()) == 2 + (size + 7) // 8
+    seatMap = SeatMap()
+    seatMap.set('E5', True)
+    assert seatMap.isTaken(len(Database.seatColumn) - 1) and not seatMap.isTaken('A1') and str(seatMap) == 'O' * 24 + 'X'
+
+def test_delta_export_marks_and_removed_screenings(cursor, tmp_path):
+    def export(consumer):
+        filename = str(tmp_path / (consumer + '.jsonl'))
+        assert run(cursor, {'op': 'export', 'delta': True, 'consumer': consumer, 'format': 'jsonl', 'file': filename})[0]['ok']
+        with open(filename) as file:
+            return sorted((i['date'], i['time'], i['status']) for i in map(json.loads, file) if i['auditorium'] == '2')
+    schedule(cursor, '2099/01/01', '11:00', 120)
+    schedule(cursor, '2099/01/02', '11:00', 120)
+    assert export('reporting') == export('audit') == [('2099/01/01', '11:00', 'changed'), ('2099/01/02', '11:00', 'changed')] # first exports are full
+    assert export('reporting') == []
+    assert cursor.makeBooking('u', '1', '2099/01/02', '11:00', '2', ['A1']) == []
+    cursor.cancelScreenings([('2099/01/01', '11:00', '2')])
+    assert export('reporting') == [('2099/01/01', '11:00', 'removed'), ('2099/01/02', '11:00', 'changed')]
+    assert export('reporting') == []
+    c = cursor.getCursor()
+    assert c.execute('SELECT count(*) FROM seatChange;').fetchone()[0] > 0 # 'audit' has not exported them yet
+    assert export('audit') == [('2099/01/01', '11:00', 'removed'), ('2099/01/02', '11:00', 'changed')]
+    assert c.execute('SELECT count(*) FROM seatChange;').fetchone()[0] == 0
+    cursor.attachArchive(str(tmp_path / 'archive.db'))
+    assert cursor.archiveScreenings('2099/01/03') >= 2
+    assert export('audit') == [('2099/01/01', '11:00', 'removed'), ('2099/01/02', '11:00', 'removed')]
+
+def test_availability_expression_adjacency():
+    free, adjacent = availabilityExpression('seats', Database.seatColumn)
+    connection = sqlite3.connect(':memory:')
+    connection.execute('CREATE TABLE seats (' + ', '.join(Database.seatColumn) + ');')
+    def count(taken):
+        connection.execute('DELETE FROM seats;')
+        connection.execute('INSERT INTO seats VALUES (' + ', '.join("'X'" if i in taken else "'O'" for i in Database.seatColumn) + ');')
+        return connection.execute('SELECT ' + free + ', ' + adjacent + ' FROM seats;').fetchone()
+    assert count([]) == (25, 5)
+    assert count(['A3', 'B3', 'C3', 'D3', 'E3']) == (20, 2)
+    assert count(['A1', 'A5', 'B2', 'B4', 'C3', 'D1', 'D2', 'D4', 'E2', 'E5']) == (15, 3) # A2 A3 A4
+    assert count([i for i in Database.seatColumn if i != 'C4']) == (1, 1)
+    assert count(Database.seatColumn) == (0, 0)
+
+def test_next_screenings(cursor):
+    schedule(cursor, '2099/01/01', '11:00', 120)
+    schedule(cursor, '2099/01/02', '11:00', 120)
+    schedule(cursor, '2099/01/03', '11:00', 120)
+    window = {'start': ('2099/01/01', '00:00'), 'end': ('2099/12/31', '23:59')}
+    assert cursor.makeBooking('u', '1', '2099/01/01', '11:00', '2', ['A3', 'B3', 'C3', 'D3', 'E3']) == []
+    assert cursor.makeBooking('u', '1', '2099/01/02', '11:00', '2', [i for i in Database.seatColumn if i[1] != '1']) == []
+    found = cursor.nextScreenings(3, **window)
+    assert [row[2:] for row in found] == [('2099/01/01', '11:00', '2', 20, 2), ('2099/01/02', '11:00', '2', 5, 1), ('2099/01/03', '11:00', '2', 25, 5)]
+    assert found[0][:2] == ('1', cursor.getCursor().execute("SELECT film FROM film WHERE filmID = '1';").fetchone()[0])
+    assert [row[2] for row in cursor.nextScreenings(3, adjacent = True, **window)] == ['2099/01/03']
+    assert [row[2] for row in cursor.nextScreenings(2, adjacent = True, **window)] == ['2099/01/01', '2099/01/03']
+    assert [row[2] for row in cursor.nextScreenings(6, **window)] == ['2099/01/01', '2099/01/03']
+    assert [row[2] for row in cursor.nextScreenings(1, start = ('2099/01/01', '11:01'), end = ('2099/01/02', '11:00'))] == ['2099/01/02']
+    assert [row[2] for row in cursor.nextScreenings(1, limit = 1, **window)] == ['2099/01/01']
+    assert cursor.nextScreenings(1, filmID = 'none', **window) == []
+    cursor.cancelScreenings([('2099/01/01', '11:00', '2')])
+    assert [row[2] for row in cursor.nextScreenings(2, adjacent = True, **window)] == ['2099/01/03']
+
+def test_profiled_cursor_times_fetches(cursor):
+    profiler = QueryProfiler(threshold = 0.05)
+    cursor.setProfiler(profiler)
+    cursor.getConnection().create_function('pause', 1, lambda value: time.sleep(0.01) or value)
+    s = 'WITH RECURSIVE n (i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 10) SELECT pause(i) FROM n;'
+    c = cursor.getCursor()
+    c.execute(s) # SQLite computes the first row only
+    assert c.fetchone() == (1,) and c.fetchmany(3) == [(2,), (3,), (4,)]
+    assert profiler.summary() == [] # rows are left, so the query is still running
+    assert [row for row in c] == [(i,) for i in range(5, 11)]
+    [[statement, calls, total, average, longest]] = profiler.summary()
+    assert calls == 1 and total >= 100 # every row paused 10 ms
+    assert [query[1] for query in profiler.getSlowQueries()] == [s]
+    c.execute(s)
+    assert len(c.fetchall()) == 10
+    assert profiler.summary()[0][1] == 2 and profiler.summary()[0][4] >= 100
+    c.execute(s)
+    c.fetchone()
+    c.execute('SELECT 1;') # the next statement records the unfinished query
+    assert profiler.summary()[0][1] == 3